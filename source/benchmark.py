@@ -0,0 +1,226 @@
+"""Benchmarks on the data structures of the engine"""
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from encode import layout
+from store import Store
+from rbtree import RBDict
+from read import Scanner, scan_file, scan_file_parallel
+from snapshot import load_snapshot, write_snapshot, snapshot_name
+from tables import tables_init, Item, Statistic, Value
+
+
+class SortedDict(object):
+    """The former sorted dictionary: a dict that sorts on every walk"""
+    __slots__ = 'data',
+
+    def __init__(self):
+        self.data = {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter([self.data[k] for k in sorted(self.data.keys())])
+
+    def __len__(self):
+        return len(self.data)
+
+
+REGEX = re.compile(r",\n *\"", re.MULTILINE)
+REGEX2 = re.compile(r"{\n *", re.MULTILINE)
+REGEX3 = re.compile(r"\n *}", re.MULTILINE)
+
+
+def regex_layout(obj):
+    """The former layout: indented JSON compacted by three regex passes"""
+    res = json.dumps(obj, indent=2, separators=(',', ':'), sort_keys=True)
+    res = REGEX.sub(", \"", res)
+    res = REGEX2.sub("{", res)
+    res = REGEX3.sub("}", res)
+    return res
+
+
+def timed(name, size, func):
+    """Run a function and show the elapsed time"""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28}{:>9} {:10.3f}s".format(name, size, elapsed))
+    return elapsed
+
+
+def bench_tree(clazz, size, walks=10):
+    """Insert, look up, walk and delete random keys"""
+    rnd = random.Random(size)
+    keys = ["{:07d}|{}".format(rnd.randrange(size * 10), nr)
+            for nr in range(size)]
+    tree = clazz()
+    name = clazz.__name__
+
+    def insert():
+        """Insert all keys"""
+        for key in keys:
+            tree[key] = key
+
+    def lookup():
+        """Look up all keys"""
+        for key in keys:
+            tree.__getitem__(key)
+
+    def walk():
+        """Walk the whole tree in key order a number of times"""
+        for _ in range(walks):
+            for _ in tree:
+                pass
+
+    def delete():
+        """Remove half of the keys"""
+        for key in keys[::2]:
+            del tree[key]
+
+    timed(name + " insert", size, insert)
+    timed(name + " lookup", size, lookup)
+    timed(name + " walk x" + str(walks), size, walk)
+    timed(name + " delete half", size, delete)
+
+
+def synthetic(file, lines, values=8):
+    """Write a data file with about the given number of lines"""
+    stats = 1000
+    items = max(1, (lines - stats * 2) // (values + 2))
+    with open(file, 'w') as fp:
+        fp.write('title=Benchmark, statistics=[\n')
+        for nr in range(stats):  # skills that refer to later trainings
+            fp.write('  type=skill, name=skill{:04d}, '
+                     'first_train={{type=training, name=train{:04d}}}, '
+                     'second_train={{type=training, name=train{:04d}}}\n'
+                     .format(nr, nr, (nr * 7) % stats))
+        for nr in range(stats):
+            fp.write('  type=training, name=train{:04d}\n'.format(nr))
+        for nr in range(stats):
+            fp.write('  type=statistic, name=stat{:04d}, '
+                     'description=Value\\, number {}\n'.format(nr, nr))
+        fp.write('], actions=[], items=[\n')
+        for nr in range(items):
+            fp.write('  type=weapon, name=item{:07d}, values=[\n'.format(nr))
+            for val in range(values):
+                fp.write('    statistic={{type=statistic, name=stat{:04d}}}, '
+                         'value={}\n'.format((nr + val * 97) % stats, val))
+            fp.write('  ]\n')
+        fp.write(']\n')
+    return stats * 3 + items * (values + 2) + 2
+
+
+def bench_scan(lines):
+    """Parse a synthetic data file and load it from a snapshot"""
+    fd, file = tempfile.mkstemp(suffix='.dbr')
+    os.close(fd)
+    try:
+        lines = synthetic(file, lines)
+        game = tables_init(Store())
+        elapsed = timed("scan_file", lines, lambda: scan_file(file, game))
+        print("{:<28}{:>9} {:10.0f}/s".format(
+            "scan_file lines", lines, lines / elapsed))
+        timed("scan_file_parallel", lines, lambda: scan_file_parallel(
+            file, tables_init(Store())))
+        timed("write_snapshot", lines, lambda: write_snapshot(file, game))
+        timed("load_snapshot", lines, lambda: load_snapshot(
+            file, tables_init(Store())))
+    finally:
+        os.unlink(file)
+        if os.path.exists(snapshot_name(file)):
+            os.unlink(snapshot_name(file))
+
+
+def bench_resolve(size):
+    """Resolve forward relations from skills to trainings"""
+    lines = ['title=Benchmark, statistics=[']
+    for nr in range(size):
+        lines.append(
+            '  type=skill, name=skill{:07d}, '
+            'first_train={{type=training, name=train{:07d}}}, '
+            'second_train={{type=training, name=train{:07d}}}'.format(
+                nr, nr, (nr * 7) % size))
+    for nr in range(size):
+        lines.append('  type=training, name=train{:07d}'.format(nr))
+    lines.append(']')
+    scan = Scanner(iter(lines))
+    scan.read(tables_init(Store()))
+    timed("resolve", size * 2, scan.resolve)
+
+
+def bench_memory(size):
+    """Memory used by values on one item, without the numbers themselves"""
+    game = tables_init(Store())
+    stat = Statistic(game)
+    stat.type = 3
+    stat.name = 'strength'
+    stat.store()
+    item = Item(game)
+    item.type = 1
+    item.name = 'sword'
+    item.store()
+    recs = [None] * size
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for nr in range(size):
+        val = Value(item)
+        val.statistic = stat
+        val.value = nr & 0xff  # small numbers are shared objects
+        recs[nr] = val
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    print("{:<28}{:>9} {:10.1f}MB {:6.1f} bytes/record".format(
+        "Value records", size, used / 1e6, used / size))
+
+    def walk():
+        """Read the fields of all values"""
+        for val in recs:
+            getattr(val, 'statistic')
+            getattr(val, 'value')
+    timed("Value field walk", size, walk)
+
+
+def bench_layout(size):
+    """Lay out a listing of items like /record/item"""
+    game = tables_init(Store())
+    for nr in range(size):
+        item = Item(game)
+        item.type = nr % 16 + 1
+        item.name = "item{:07d}".format(nr)
+        item.store()
+    listing = [{'key': rec.get_id(), 'show': rec.name} for rec in game.items]
+    res = {}
+    for func in (regex_layout, layout):
+        timed(func.__name__, size, lambda f=func: res.setdefault(
+            f.__name__, f(listing)))
+    if res['regex_layout'] != res['layout']:
+        raise ValueError("Layouts differ")
+
+
+def main(sizes):
+    """Run all benchmarks on the given sizes"""
+    for size in sizes:
+        for clazz in (SortedDict, RBDict):
+            bench_tree(clazz, size)
+    bench_scan(sizes[-1])
+    bench_resolve(sizes[-1] // 10)
+    bench_memory(sizes[-1])
+    bench_layout(50000)
+
+
+if __name__ == "__main__":
+    main([int(s) for s in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,44 @@
+"""Cache of responses that stay valid while their tables do not change"""
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """The least recently used responses on their url, each with the
+       versions of the tables it was made from"""
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()  # url to (versions, response)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, url, versions, make):
+        """The cached response when the tables are still at the same
+           versions, otherwise make a new one and remember it"""
+        entry = self.entries.get(url)
+        if entry is not None and entry[0] == versions:
+            self.entries.move_to_end(url)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        res = make()
+        self.entries[url] = versions, res
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return res
+
+    def clear(self):
+        """Forget all responses"""
+        self.entries.clear()
+
+    def stats(self):
+        """Counters to size the cache with"""
+        show = OrderedDict()
+        show['size'] = self.size
+        show['entries'] = len(self.entries)
+        show['hits'] = self.hits
+        show['misses'] = self.misses
+        show['evictions'] = self.evictions
+        return show
@@ -0,0 +1,130 @@
+"""Optional columnar copy of numeric sub records for vectorized queries"""
+try:
+    import numpy
+except ImportError:  # numpy is only needed for the columns
+    numpy = None
+
+from fields import Set
+
+
+class Columns(object):
+    """Number field of sub records, like the value of a Value, as one array
+       per related record, like a Statistic, indexed on the ordinal of the
+       parent row, like an Item. A mask tells which rows hold a value.
+       Numeric fields of the rows named in groups are kept as arrays too.
+       A row without values is dropped and its ordinal used again."""
+    def __init__(self, store, clazz, relation, number, groups=()):
+        if numpy is None:
+            raise ImportError("Columnar storage needs numpy")
+        self.clazz = clazz
+        self.relation = relation
+        self.number = number
+        self.rows = []  # parent records on their ordinal, None when dropped
+        self.free = []  # ordinals of dropped rows to use again
+        self.ordinal = {}  # id of a parent record to its ordinal
+        self.values = {}  # id of a related record to its array of numbers
+        self.valid = {}  # id of a related record to its mask
+        self.groups = {name: numpy.zeros(16, numpy.int64) for name in groups}
+        self.capacity = 16
+        store.columns.append(self)
+        if store.root is not None:
+            self._fill(store.root)
+
+    def _fill(self, rec):
+        """Add the stored sub records below a record"""
+        for fld in rec.fields:
+            if isinstance(fld, Set) and fld.primary:
+                for sub in getattr(rec, fld.name):
+                    if isinstance(sub, self.clazz):
+                        self.add(sub)
+                    self._fill(sub)
+
+    def _grow(self):
+        """Double the length of all arrays"""
+        self.capacity *= 2
+        for arrays in (self.values, self.valid, self.groups):
+            for key, arr in arrays.items():
+                new = numpy.zeros(self.capacity, arr.dtype)
+                new[:len(arr)] = arr
+                arrays[key] = new
+
+    def _row(self, row):
+        """Ordinal of a parent record, new parents get the next one"""
+        nr = self.ordinal.get(id(row))
+        if nr is None:
+            if self.free:
+                nr = self.free.pop()
+                self.rows[nr] = row
+            else:
+                nr = len(self.rows)
+                if nr == self.capacity:
+                    self._grow()
+                self.rows.append(row)
+            self.ordinal[id(row)] = nr
+        return nr
+
+    def add(self, rec):
+        """Copy the number of a stored sub record into its column"""
+        target = getattr(rec, self.relation)
+        if target is None:
+            return
+        nr = self._row(rec.parent)
+        if id(target) not in self.values:
+            self.values[id(target)] = numpy.zeros(self.capacity, numpy.int64)
+            self.valid[id(target)] = numpy.zeros(self.capacity, numpy.bool_)
+        self.values[id(target)][nr] = getattr(rec, self.number) or 0
+        self.valid[id(target)][nr] = True
+        for name, arr in self.groups.items():
+            arr[nr] = getattr(rec.parent, name) or 0
+
+    def remove(self, rec):
+        """Clear the value of a removed sub record, drop its row when no
+           other values are left on it"""
+        target = getattr(rec, self.relation)
+        nr = self.ordinal.get(id(rec.parent))
+        if target is None or nr is None or id(target) not in self.valid:
+            return
+        self.valid[id(target)][nr] = False
+        if not any(valid[nr] for valid in self.valid.values()):
+            del self.ordinal[id(rec.parent)]
+            self.rows[nr] = None
+            self.free.append(nr)
+
+    def column(self, target):
+        """Numbers and mask of all rows for a related record"""
+        size = len(self.rows)
+        if id(target) not in self.values:
+            return (numpy.zeros(size, numpy.int64),
+                    numpy.zeros(size, numpy.bool_))
+        return (self.values[id(target)][:size],
+                self.valid[id(target)][:size])
+
+    def _selected(self, target, where):
+        """Ordinals of the rows with a value that match the group values"""
+        values, valid = self.column(target)
+        mask = valid.copy()
+        for name, val in where.items():
+            if name not in self.groups:
+                raise KeyError(name + " is no group of the columns")
+            mask &= self.groups[name][:len(self.rows)] == val
+        return values, numpy.nonzero(mask)[0]
+
+    def sorted_rows(self, target, reverse=False, **where):
+        """Rows holding a value for target ordered on that value, only
+           the rows with the given group values"""
+        values, selected = self._selected(target, where)
+        keys = values[selected]
+        order = numpy.argsort(-keys if reverse else keys, kind='stable')
+        return [self.rows[nr] for nr in selected[order]]
+
+    def mean_by(self, target, group, **where):
+        """Mean value of target per value of a group field"""
+        values, selected = self._selected(target, where)
+        if len(selected) == 0:
+            return {}
+        found, inverse = numpy.unique(
+            self.groups[group][selected], return_inverse=True)
+        sums = numpy.bincount(inverse, weights=values[selected])
+        counts = numpy.bincount(inverse)
+        return {int(val): float(total / count)
+                for val, total, count in zip(found, sums, counts)}
@@ -0,0 +1,87 @@
+"""Group commit of the writes that arrive close together"""
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class GroupCommit(object):
+    """Writes that are acknowledged together after a single shared commit,
+       made after a window of time or when enough writes wait for it"""
+    def __init__(self, commit, executor, window=0.01, batch=100):
+        self.commit = commit  # makes the waiting writes durable
+        self.executor = executor  # commits after the calls before it
+        self.window = window  # seconds writes wait for a shared commit
+        self.batch = batch  # commit at once when this many writes wait
+        self.grouping = False  # leave the commit to the group
+        self.pending = 0  # accepted writes that are not yet durable
+        self.committed = None  # future of the running group of writes
+        self.started = 0
+        self.metrics = OrderedDict(
+            [('commits', 0), ('writes', 0), ('largest', 0),
+             ('latency', 0.0), ('slowest', 0.0)])
+
+    def call(self, func, *args):
+        """Call func without waiting for the commit, also return if there
+           are writes waiting for it"""
+        self.grouping = True
+        before = self.pending
+        try:
+            return func(*args), self.pending > before
+        finally:
+            self.grouping = False
+
+    async def wait(self):
+        """Commit the writes of a group after the window or when the group
+           is full, then acknowledge them all"""
+        loop = asyncio.get_event_loop()
+        if self.committed is None:
+            self.committed = loop.create_future()
+            self.started = time.perf_counter()
+            loop.call_later(self.window, self._commit_group)
+        done = self.committed
+        if self.pending >= self.batch:
+            self._commit_group()
+        await done
+
+    def _commit_group(self):
+        """Start the commit of the current group of writes"""
+        done = self.committed
+        if done is None:
+            return  # already committed because the group was full
+        self.committed = None
+        started = self.started
+        asyncio.ensure_future(self._commit(done, started))
+
+    async def _commit(self, done, started):
+        """Commit in the worker thread after the calls before it, a failed
+           commit fails all the writes of the group and is raised to the
+           event loop to be logged"""
+        try:
+            count = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self.commit)
+        except Exception as e:
+            done.set_exception(e)
+            raise
+        latency = time.perf_counter() - started
+        metrics = self.metrics
+        if count:
+            metrics['commits'] += 1
+            metrics['writes'] += count
+            metrics['largest'] = max(metrics['largest'], count)
+            metrics['latency'] += latency
+            metrics['slowest'] = max(metrics['slowest'], latency)
+        done.set_result(count)
+
+    def stats(self):
+        """Sizes and latencies of the group commits"""
+        metrics = self.metrics
+        show = OrderedDict()
+        show['commits'] = metrics['commits']
+        show['writes'] = metrics['writes']
+        show['largest batch'] = metrics['largest']
+        show['mean batch'] = round(
+            metrics['writes'] / max(1, metrics['commits']), 2)
+        show['mean latency ms'] = round(
+            metrics['latency'] * 1000 / max(1, metrics['commits']), 3)
+        show['slowest ms'] = round(metrics['slowest'] * 1000, 3)
+        return show
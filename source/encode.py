@@ -0,0 +1,71 @@
+"""Compact JSON layout of responses written in a single pass"""
+from json import dumps
+from json.encoder import encode_basestring_ascii
+
+CHUNK_SIZE = 1 << 16
+
+
+def _scalar(obj):
+    """JSON of a value that is no list or dictionary"""
+    if isinstance(obj, str):
+        return encode_basestring_ascii(obj)
+    if obj is None:
+        return 'null'
+    if obj is True:
+        return 'true'
+    if obj is False:
+        return 'false'
+    if isinstance(obj, int):
+        return int.__repr__(obj)
+    return dumps(obj)
+
+
+def _parts(obj, depth, out):
+    """Append the JSON of a value on the given depth to out. Dictionaries
+       stay on one line with sorted keys, list items start on their own
+       line except for strings after the first item."""
+    if isinstance(obj, dict):
+        if not obj:
+            out.append('{}')
+            return
+        sep = '{'
+        for key in sorted(obj):
+            out.append(sep)
+            out.append(encode_basestring_ascii(str(key)))
+            out.append(':')
+            _parts(obj[key], depth + 1, out)
+            sep = ', '
+        out.append('}')
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            out.append('[]')
+            return
+        indent = ',\n' + '  ' * (depth + 1)
+        sep = indent[1:]
+        out.append('[')
+        for item in obj:
+            if isinstance(item, str):
+                out.append(sep if sep != indent else ', ')
+                out.append(encode_basestring_ascii(item))
+            else:
+                out.append(sep)
+                _parts(item, depth + 1, out)
+            sep = indent
+        out.append('\n' + '  ' * depth + ']')
+    else:
+        out.append(_scalar(obj))
+
+
+def layout(obj):
+    """JSON version of the data structure"""
+    out = []
+    _parts(obj, 0, out)
+    return ''.join(out)
+
+
+def chunks(text, size=CHUNK_SIZE):
+    """Split a response that is already laid out in the frames of a
+       fragmented message, this keeps the frames small but the whole
+       response is still in memory"""
+    for pos in range(0, len(text), size):
+        yield text[pos:pos + size]
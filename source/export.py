@@ -1,7 +1,56 @@
 """Show html content"""
+from urllib.parse import quote
 
+from fields import Set, parse_id
+from html import Writer, page_header, page, table, line, table_finish
+from html import buttons, page_footer
 
-# pylint:disable=unused-argument
-def serve(general, record, data):
-    """Show a page"""
-    pass
+PAGE_SIZE = 100
+
+
+def serve(snap, record, data, send=None):
+    """Write a page of the records of a table after the key in data['after']
+       with at most data['limit'] lines as they were when the snapshot was
+       pinned. With send and data['stream'] each line is passed to send
+       when it is written."""
+    stream = data.get('stream') not in (None, '', '0', 'false', 0, False)
+    out = Writer(send=send if stream else None)
+    limit = int(data.get('limit', PAGE_SIZE))
+    if limit <= 0:
+        raise ValueError('Incorrect limit ' + str(limit))
+    after = data.get('after')
+    key = None
+    if after:
+        key = parse_id(record, after)
+        if key is None:
+            raise ValueError('Incorrect key "' + after + '"')
+    names = [fld.name for fld in record.fields if not isinstance(fld, Set)]
+    title = record.__name__
+    page_header(out, title)
+    page(out, title)
+    table(out, *names)
+    out.flush()
+    last = None
+    more = False
+    name = record.__name__.lower()
+    for rkey, rec in snap.table(record).range(from_key=key):
+        if rkey == key:
+            continue  # the last line of the previous page
+        if limit == 0:
+            more = True
+            break
+        rec = snap.view(rec)
+        line(out, rec, *names)
+        out.flush()
+        last = rec
+        limit -= 1
+    if more:
+        out.write(
+            '<tr class="more"><td colspan="', len(names), '"><a href="/list/',
+            name, '?after=', quote(last.get_id()), '&amp;limit=',
+            data.get('limit', PAGE_SIZE), '">more</a></td></tr>\n')
+    table_finish(out)
+    buttons(out)
+    page_footer(out)
+    out.flush()
+    return out
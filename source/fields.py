@@ -3,46 +3,76 @@ import re
 from abc import ABCMeta, abstractmethod
 from datetime import date, datetime
 
+from rbtree import RBDict
+
 # pylint: disable=no-self-use
 
 LINE_LENGTH = 120
 
 
-class Store(object):
-    """Central object holding a data store"""
-    def __init__(self):
-        self.root = None
-        self._changes = False
-
-    def changes(self, remember_changes=True):
-        """Start or stop remembering changes on records"""
-        self._changes = remember_changes
-        for fld in self.root.fields:
-            if not isinstance(fld, Set) or not fld.primary:
-                continue
-            getattr(self.root, fld.name).remember_changes(self._changes)
-
-    def init(self, root):
-        """Set the root product of the store"""
-        self.root = root
-
-    def register(self, *classes):
-        """Register a set of classes to the store"""
-        names = {}
-        for fld in self.root.fields:
-            names[fld.name] = fld
-        setattr(self.root.__class__, 'field_on_name', names)
-        setattr(self.root.__class__, 'data_store', self)
-        for clazz in classes:
-            names = {}
-            for fld in clazz.fields:
-                names[fld.name] = fld
-            setattr(clazz, 'field_on_name', names)
-            setattr(clazz, 'data_store', self)
+def _index_value(fld, val):
+    """Comparable index value of a field, related records on identity"""
+    if val is None:
+        return False, None
+    if isinstance(fld, Relation):
+        return True, id(val)
+    return True, val
+
+
+def _record_path(rec, ids=False):
+    """Keys, or ids for the client, of the record and its parents below the
+       root"""
+    path = (rec.get_id() if ids else rec.get_key(),)
+    parent = getattr(rec, 'parent', None)
+    while getattr(parent, 'parent', None) is not None:
+        path = (parent.get_id() if ids else parent.get_key(),) + path
+        parent = parent.parent
+    return path
+
+
+def _split_key_repr(text):
+    """Read the fields of a relation key presentation like {type=a, name=b}"""
+    if not text.startswith('{') or not text.endswith('}'):
+        raise ValueError("Invalid relation '" + text + "'")
+    data = {}
+    for part in re.split(r"(?<!\\), ", text[1:-1]):
+        key, _, value = part.partition('=')
+        data[key] = value.replace("\\,", ",")
+    return data
+
+
+def parse_id(clazz, text, prefix=False):
+    """Typed key of a record of clazz from the presentation of get_id, or
+       only the leading key fields of a prefix ending with '|'. Returns None
+       when the text is no valid key."""
+    keys = clazz.key_fields(clazz)
+    if prefix:
+        if not text.endswith('|'):
+            return None
+        parts = text[:-1].split('|', len(keys) - 1)
+    else:
+        parts = text.split('|', len(keys) - 1) if keys else []
+    if len(parts) > len(keys) or (not prefix and len(parts) < len(keys)):
+        return None
+    res = []
+    try:
+        for name, part in zip(keys, parts):
+            fld = clazz.field_on_name[name]
+            if isinstance(fld, (Number, Enum)):
+                res.append(int(part))
+            elif isinstance(fld, Relation):
+                res.append(fld.key(_split_key_repr(part)))
+            else:
+                res.append(fld.read(part))
+    except (ValueError, KeyError):
+        return None
+    return tuple(res)
 
 
 class Number:
     """Number type"""
+    default = 0
+
     def __init__(self, name, allow_null=False):
         self.name = name
         self.allow_null = allow_null
@@ -74,6 +104,8 @@ class Number:
 
 class Amount:
     """Amount type"""
+    default = 0
+
     def __init__(self, name, allow_null=False):
         self.name = name
         self.allow_null = allow_null
@@ -109,6 +141,8 @@ class Amount:
 
 class Enum:
     """Enum type with a set of values"""
+    default = None
+
     def __init__(self, name, values, allow_null=False):
         self.name = name
         self.values = values
@@ -139,6 +173,7 @@ class Enum:
 class Date:
     """Date field"""
     date_format = '%Y-%m-%d'
+    default = None
 
     def __init__(self, name, allow_null=False):
         self.name = name
@@ -164,6 +199,8 @@ class Date:
 
 class String:
     """String field"""
+    default = None
+
     def __init__(self, name, allow_null=False):
         self.name = name
         self.allow_null = allow_null
@@ -185,6 +222,8 @@ class String:
 
 class Boolean:
     """Boolean field"""
+    default = False
+
     def __init__(self, name, allow_null=False):
         self.name = name
         self.allow_null = allow_null
@@ -204,21 +243,29 @@ class Boolean:
 
 class Relation:
     """Relation to another record"""
+    default = None
+
     def __init__(self, name, related, allow_null=False):
         self.name = name
         self.related = related
         self.allow_null = allow_null
 
     def read(self, data):
-        """Read data from a file"""
-        find = None
-        for key in self.related.keys:
-            fld = self.related.field_on_name[key]
-            find = fld.read(data)
-        root = self.related.data_store.root
-        if self.related.path:
-            return getattr(root, self.related.path)[find]
-        return root
+        """Read the id of the related record or a dict with its key fields"""
+        if data is None or data == '':
+            return None
+        if isinstance(data, dict):
+            found = self.find(data)
+        elif self.related.path:
+            root = self.related.data_store.root
+            key = parse_id(self.related, str(data))
+            found = None if key is None else \
+                getattr(root, self.related.path).get(key)
+        else:
+            return self.related.data_store.root
+        if found is None:
+            raise KeyError(str(data))
+        return found
 
     def write(self, data):
         """Write data to a file"""
@@ -232,9 +279,17 @@ class Relation:
             return "???"
         return data.show()
 
+    def key(self, data):
+        """Tuple of the typed key values of the related record"""
+        names = self.related.field_on_name
+        return tuple(names[key].read(data[key]) for key in self.related.keys)
+
     def find(self, data):
-        """Find a related record"""
-        return self.related.find(self.related, data=data)
+        """Find a related record on the hash index of its table"""
+        keyed = self.related.data_store.keyed.get(self.related)
+        if keyed is None:
+            return None
+        return keyed.get(self.key(data))
 
 
 class Set:
@@ -246,8 +301,47 @@ class Set:
         self.allow_null = True
 
 
-class Record(metaclass=ABCMeta):
+class Index:
+    """Secondary index on one or more fields of a record"""
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = keys
+
+
+class RecordMeta(ABCMeta):
+    """Give record classes slots for their fields instead of a __dict__,
+       a __slots__ in the class body can list the fields for static checks
+       and lists the attributes beyond the fields"""
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('fields')
+        if fields is not None:
+            extra = namespace.get('__slots__', ())
+            if isinstance(extra, str):
+                extra = (extra,)
+            names = [fld.name for fld in fields]
+            namespace['__slots__'] = tuple(
+                names + [slot for slot in extra if slot not in names])
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Record(metaclass=RecordMeta):
     """Record"""
+    __slots__ = 'parent', 'cached_key'
+    indexes = []
+    field_on_name = {}  # set by Store.register
+    data_store = None  # set by Store.register
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.cached_key = None
+        store = getattr(self, 'data_store')
+        versions = None if store is None else store.generations
+        for fld in getattr(self, 'fields'):
+            if isinstance(fld, Set):
+                setattr(self, fld.name, RBDict(versions=versions))
+            else:
+                setattr(self, fld.name, fld.default)
+
     def root(self):
         """Get the root object of the data store"""
         return getattr(self, 'data_store').root
@@ -267,6 +361,17 @@ class Record(metaclass=ABCMeta):
         """Routine to check if a record may safely be removed"""
         return None
 
+    def referenced(self):
+        """Problem report when other records still relate to this record"""
+        used = getattr(self, 'data_store').referenced_by(self)
+        if not used:
+            return None
+        return {
+            'message': 'Still used by other records',
+            'used': sorted(
+                rec.get_name() + '/' + '/'.join(_record_path(rec, True))
+                for rec in used)}
+
     def get_name(self):
         """Return the name of the current record"""
         return self.__class__.__name__.lower()
@@ -279,16 +384,58 @@ class Record(metaclass=ABCMeta):
         return names[name]
 
     def imp(self, data, change=False):
-        """Read a dict of values into this record"""
+        """Read a dict of values into this record, a change that fails is
+           undone and the record is stored again"""
+        store = getattr(self, 'data_store')
+        undo = None
         if change:
+            store.keep(self)
             self.remove()
+            undo = []
+        try:
+            self.read(data, undo)
+            if undo and store.trans is not None:
+                store.trans.log += undo
+            keyed = store.keyed.get(self.__class__)
+            if keyed and keyed.get(self.get_key(), self) is not self:
+                raise ValueError("Remove an item before storing a changed one")
+            self.store()
+        except ValueError:
+            if undo is not None:
+                self._undo(undo)
+                self.store()
+            raise
+        if undo and store.undo is not None:
+            store.undo.extend(undo)
+
+    def read(self, data, undo=None):
+        """Set the fields from a dict of values without storing the record,
+           the old values are added to undo when given"""
         names = getattr(self, 'field_on_name')
+        store = getattr(self, 'data_store')
         for key, value in data.items():
-            if key in names:
+            if key not in names:
+                raise ValueError("Unknown field '" + key + "'")
+            if undo is not None:
+                undo += self, key, getattr(self, key)
+            if isinstance(names[key], Relation):
+                store.relate(self, key, names[key].read(value))
+            else:
                 setattr(self, key, names[key].read(value))
+            if key in self.key_fields():
+                setattr(self, 'cached_key', None)
+
+    def _undo(self, undo):
+        """Put back the old values of a change that is not stored"""
+        store = getattr(self, 'data_store')
+        names = getattr(self, 'field_on_name')
+        for pos in range(len(undo) - 2, 0, -3):
+            key, value = undo[pos], undo[pos + 1]
+            if isinstance(names[key], Relation):
+                store.relate(self, key, value)
             else:
-                raise ValueError("Unknown field '" + key + "'")
-        self.store()
+                setattr(self, key, value)
+        setattr(self, 'cached_key', None)
 
     def validate(self, data, add=False):
         """Validate the given field data"""
@@ -321,26 +468,45 @@ class Record(metaclass=ABCMeta):
                     res[key] = 'Cannot be empty'
         return res
 
+    def key_fields(self):
+        """Names of the fields that identify this record"""
+        id_fld = getattr(self, 'id_fld', None)
+        return [id_fld] if id_fld else getattr(self, 'keys')
+
     def get_key(self):
-        """Create a presentation of the keys of this record"""
+        """Typed key of this record, cached until a key field changes"""
+        key = getattr(self, 'cached_key', None)
+        if key is None:
+            ls = []
+            for name in self.key_fields():
+                val = getattr(self, name)
+                if val is not None and isinstance(self.field(name), Relation):
+                    val = val.get_key()
+                ls.append(val)
+            key = tuple(ls)
+            setattr(self, 'cached_key', key)
+        return key
+
+    def get_id(self):
+        """Create a presentation of the id of this record for the client,
+           key fields that are not set yet are left empty"""
         ls = []
-        for key in getattr(self, 'keys'):
-            fld = self.field(key)
-            if isinstance(fld, Number) or isinstance(fld, Enum):
-                ls.append("{:07d}".format(getattr(self, key)))
+        for name, val in zip(self.key_fields(), self.get_key()):
+            fld = self.field(name)
+            if val is None:
+                ls.append('')
+            elif isinstance(fld, Relation):
+                ls.append(getattr(self, name).key_repr())
+            elif isinstance(val, int) and not isinstance(val, bool):
+                ls.append("{:07d}".format(val))
             else:
-                ls.append(str(fld.write(getattr(self, key))))
+                ls.append(str(fld.write(val)))
         return '|'.join(ls)
 
-    def get_id(self):
-        """Create a presentation of the id of this record"""
-        id_fld = getattr(self, 'id_fld', None)
-        if not id_fld:
-            return self.get_key()
-        val = getattr(self, id_fld)
-        if isinstance(val, int):
-            return "{:07d}".format(val)
-        return self.field(id_fld).write(val)
+    def show(self):
+        """Text to show the record with: its key fields"""
+        return ' '.join(self.field(name).show(getattr(self, name))
+                        for name in self.key_fields())
 
     def key_repr(self):
         """Create a presentation of the key of this record"""
@@ -361,11 +527,13 @@ class Record(metaclass=ABCMeta):
         return ''.join(out.ls)
 
     def changes(self):
-        """Show only changes to the structure"""
-        out = Output()
+        """Show only changes to the structure, the undo log of the root is
+           cleared after it"""
         store = getattr(self, 'data_store')
-        changed = getattr(store, 'changed', self)
-        out.changes(changed, self, 0)
+        out = Output(store.undo or ())
+        out.changes(self, self, 0)
+        if store.undo and self is store.root:
+            del store.undo[:]
         return ''.join(out.ls)
 
     def output(self, file):
@@ -378,12 +546,30 @@ class Record(metaclass=ABCMeta):
         fp.close()
 
 
+class Before(object):
+    """A changed record seen with the old values of its fields"""
+    __slots__ = 'rec', 'old'
+
+    def __init__(self, rec, old):
+        self.rec = rec
+        self.old = old
+
+    def __getattr__(self, name):
+        if name in self.old:
+            return self.old[name]
+        return getattr(self.rec, name)
+
+
 class Output(object):
     """Make string presentation"""
-    def __init__(self):
+    def __init__(self, undo=()):
         self.pos = 0
         self.ls = []
         self.start = True  # before first field on a line
+        self.before = {}  # id of a changed record to its first old values
+        for pos in range(0, len(undo), 3):
+            self.before.setdefault(id(undo[pos]), {}).setdefault(
+                undo[pos + 1], undo[pos + 2])
 
     def _write(self, val, indent):
         """Try to fit a value on the current line"""
@@ -456,8 +642,14 @@ class Output(object):
         recs = getattr(rec, fld.name)
         if not recs.has_changes():
             return
+        changes = [
+            (old, cur) for old, cur in recs.changes()
+            if old is not cur and (old is not None or cur is not None) or
+            id(cur) in self.before]  # skip restored and short lived records
+        if not changes:
+            return
         self._write(fld.name + '=[\n', indent)
-        for old, cur in recs.changes():
+        for old, cur in changes:
             self.changes(old, cur, indent + 1)
             self.ls.append('\n')
             self.pos = 0
@@ -467,6 +659,8 @@ class Output(object):
 
     def changes(self, old, cur, indent):
         """Show minimalized changes between two objects"""
+        if old is not None and id(old) in self.before:
+            old = Before(old, self.before[id(old)])
         if old is None:  # new record.. show all
             self.to_str(cur, indent)
             return
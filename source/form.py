@@ -1,13 +1,13 @@
 """Code to show a form in HTML"""
-from html import serving, write, page_header, page_footer
+from html import page_header, page_footer
 from fields import Date, Amount, Number, Enum, Relation
 
 
-def form(rec, title):
-    """Generate HTML content for a general form"""
-    root = rec.data_store.root
-    serving()
-    page_header(title)
+def form(out, rec, title, snap):
+    """Write the HTML content of a general form, the options of relations
+       as they were when the snapshot was pinned"""
+    write = out.write
+    page_header(out, title)
     write('<form action="" method="post" id="form"><table>')
     has_date = False
     for fld in rec.fields:
@@ -33,16 +33,10 @@ def form(rec, title):
             write('</select>\n')
         elif isinstance(fld, Relation):
             write('<select name="' + fld.name + '">\n')
-            ls = []
             if fld.allow_null:
-                ls.append(('', ''))
-            for rec in getattr(root, fld.related.path):
-                ls.append((rec.get_id(), rec.show()))
-            for key, value in ls:
-                sel = 'selected' if key == val else ''
-                write(
-                    '<option value="' + key + '"', sel + '>', value,
-                    '</option>\n')
+                write('<option value=""></option>\n')
+            write(snap.options(fld.related).get_html(
+                val.get_id() if val else None))
             write('</select>\n')
         else:
             write(inp, '>')
@@ -62,8 +56,8 @@ def form(rec, title):
             'datepicker({ dateFormat: "yy-mm-dd" });});\n')
     write(
         '$( "#form" ).submit(function( event ) {\n' +
-        'json_form("' + rec.get_name() + '", "' + rec.get_key() +
+        'json_form("' + rec.get_name() + '", "' + rec.get_id() +
         '", $( this ).serializeArray());\n' +
         'event.preventDefault();});\n')
     write("</script>\n")
-    return page_footer()
+    page_footer(out)
@@ -1,81 +1,103 @@
 """Routines to efficiently export to HTML"""
-import io
-
 from enum import Enum
 from fields import Relation
 
-CURRENT = None
-
 
-def write(*values):
-    """Write a set of values to the current HTML file"""
-    for value in values:
-        CURRENT.write(str(value))
+class Writer(object):
+    """Collects the fragments of one HTML page, they are only joined when
+       the page is finished. Every render has its own writer so pages can
+       be made at the same time. With send the written fragments are passed
+       on whenever the page is flushed."""
+    def __init__(self, name=None, send=None):
+        self.name = name
+        self.send = send
+        self.parts = []
+
+    def write(self, *values):
+        """Add a set of values to the page"""
+        self.parts.extend(values)
+
+    def flush(self):
+        """Pass the fragments written until now to send"""
+        if self.send is not None and self.parts:
+            self.send(''.join(map(str, self.parts)))
+            self.parts = []
+
+    def getvalue(self):
+        """The whole page content"""
+        return ''.join(map(str, self.parts))
+
+    def chunks(self, size):
+        """The page content in pieces of at least size characters to send
+           it without joining the whole page first"""
+        buf = []
+        length = 0
+        for part in self.parts:
+            part = str(part)
+            buf.append(part)
+            length += len(part)
+            if length >= size:
+                yield ''.join(buf)
+                buf = []
+                length = 0
+        if buf or not self.parts:
+            yield ''.join(buf)
+
+    def close(self):
+        """Write the page to its file when it has a name"""
+        if self.name:
+            with open(self.name, 'w') as out:
+                out.writelines(map(str, self.parts))
+        self.parts = []
 
 
 def file(name, title):
     """Start a new html file"""
-    global CURRENT
-    if CURRENT:
-        finish()
-    CURRENT = open(name, 'w')
-    page_header(title)
+    out = Writer(name)
+    page_header(out, title)
+    return out
 
 
-def page_header(title):
+def page_header(out, title):
     """Show the page header"""
-    write('<!DOCTYPE HTML>\n')
-    write('<html>\n')
-    write('<head>\n')
-    write('  <meta charset="UTF-8">\n')
-    write('  <title>', title, '</title>\n')
-    write('  <link rel="stylesheet" href="jquery/jquery-ui.css">\n')
-    write('  <script src="jquery/jquery.js"></script>\n')
-    write('  <script src="jquery/jquery-ui.min.js"></script>\n')
-    write('  <script src="forms.js"></script>\n')
-    write('  <link rel="stylesheet" type="text/css" href="theme.css">\n')
-    write('</head>\n')
-    write('<body>\n')
-
-
-def page_footer():
-    """Show the page footer, close it and return the whole page content"""
-    global CURRENT
-    write('</body>\n</html>')
-    res = CURRENT.getvalue()
-    CURRENT.close()
-    CURRENT = None
-    return res
-
-
-def serving():
-    """Start a html page that will be returned by the server"""
-    global CURRENT
-    if CURRENT:
-        finish()
-    CURRENT = io.StringIO()
-
-
-def page(title):
+    out.write(
+        '<!DOCTYPE HTML>\n<html>\n<head>\n  <meta charset="UTF-8">\n',
+        '  <title>', title, '</title>\n',
+        '  <link rel="stylesheet" href="jquery/jquery-ui.css">\n',
+        '  <script src="jquery/jquery.js"></script>\n',
+        '  <script src="jquery/jquery-ui.min.js"></script>\n',
+        '  <script src="forms.js"></script>\n',
+        '  <link rel="stylesheet" type="text/css" href="theme.css">\n',
+        '</head>\n<body>\n')
+
+
+def page_footer(out):
+    """Show the page footer"""
+    out.write('</body>\n</html>')
+
+
+def page(out, title):
     """Write the header of a html page"""
-    write('<h1>', title, '</h1>\n')
+    out.write('<h1>', title, '</h1>\n')
+
+
+def buttons(out):
+    """Script to show the edit buttons on the page"""
+    out.write(
+        "<script>\n",
+        '$("button").button({icons:{primary:"ui-icon-edit"},text:false});\n',
+        "</script>")
 
 
-def finish(show_result=False):
-    """Finish writing to the current HTML file"""
-    global CURRENT
-    write("<script>\n")
-    write('$("button").button({icons:{primary:"ui-icon-edit"},text:false});\n')
-    write("</script>")
+def finish(out, show_result=False):
+    """Finish writing to the HTML file, with show_result the page written
+       so far is returned instead"""
+    buttons(out)
     if show_result:
-        res = CURRENT.getvalue()
-        CURRENT.close()
-        CURRENT = None
-        return res
-    write('\n</body>\n')
-    write('</html>')
-    CURRENT.close()
-    CURRENT = None
+        return out.getvalue()
+    out.write('\n</body>\n', '</html>')
+    out.close()
+    return None
 
 
 def edit(rec, rid):
@@ -85,18 +107,18 @@ def edit(rec, rid):
     return out
 
 
-def table(*names):
+def table(out, *names):
     """Start a table"""
-    write("<table>\n")
-    headers(*names)
+    out.write("<table>\n")
+    headers(out, *names)
 
 
-def headers(*names):
+def headers(out, *names):
     """Write headers to a table"""
-    write("<tr>")
+    out.write("<tr>")
     for name in names:
-        write("<th>", name, "</th>")
-    write("</tr>\n")
+        out.write("<th>", name, "</th>")
+    out.write("</tr>\n")
 
 
 class DType(Enum):
@@ -106,22 +128,22 @@ class DType(Enum):
     normal = 3
 
 
-def detail(dtype, *values):
+def detail(out, dtype, *values):
     """Show detail records"""
     if dtype == DType.total:
-        write('<tr class="total">')
+        out.write('<tr class="total">')
     else:
-        write('<tr>')
+        out.write('<tr>')
     first = True
     for value in values:
         if dtype == DType.header and first:
-            write('<th>', value, '</th>')
+            out.write('<th>', value, '</th>')
         elif value.endswith('#'):
-            write('<td class="amount">', value[:-1], '</td>')
+            out.write('<td class="amount">', value[:-1], '</td>')
         else:
-            write('<td>', value, '</td>')
+            out.write('<td>', value, '</td>')
         first = False
-    write('</tr>\n')
+    out.write('</tr>\n')
 
 
 def link(text, href):
@@ -129,7 +151,7 @@ def link(text, href):
     return '<a href="' + href + '">' + str(text) + '</a>'
 
 
-def create_link(rec, fld, fldexpr, pos):
+def create_link(out, rec, fld, fldexpr, pos):
     """Create a link from a given expression"""
     if isinstance(rec.field(fld), Relation):
         val = getattr(rec, fld)
@@ -140,42 +162,43 @@ def create_link(rec, fld, fldexpr, pos):
     repltill = expr.find(']')
     if val:
         lpart = getattr(val, expr[replfrom + 1:repltill])
-        write('<a href="', expr[:replfrom], lpart, expr[repltill + 1:], '">')
+        out.write(
+            '<a href="', expr[:replfrom], lpart, expr[repltill + 1:], '">')
 
 
-def line(rec, *fields):
+def line(out, rec, *fields):
     """Write a line to the table"""
-    write("<tr>")
+    out.write("<tr>")
     first = True
     ebt = edit(rec.get_name(), rec.get_id())
     for fldexpr in fields:
         pos = fldexpr.find("#")
         if first:
-            write("<th>" + ebt)
+            out.write("<th>" + ebt)
         else:
             if pos + 1 == len(fldexpr):
-                write('<td class="amount">')
+                out.write('<td class="amount">')
             else:
-                write('<td>')
+                out.write('<td>')
 
         if pos > 0:
             fld = fldexpr[:pos]
             if pos < len(fldexpr) - 1:
-                create_link(rec, fld, fldexpr, pos)
+                create_link(out, rec, fld, fldexpr, pos)
         else:
             fld = fldexpr
         val = getattr(rec, fld)
-        write(rec.field(fld).show(val) if val else '')
+        out.write(rec.field(fld).show(val) if val else '')
         if 0 < pos < len(fldexpr) - 1:
-            write("</a>")
+            out.write("</a>")
         if first:
-            write("</th>\n")
+            out.write("</th>\n")
             first = False
         else:
-            write("</td>")
-    write("</tr>\n")
+            out.write("</td>")
+    out.write("</tr>\n")
 
 
-def table_finish():
+def table_finish(out):
     """Stop the current table"""
-    write("</table>")
+    out.write("</table>")
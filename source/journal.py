@@ -0,0 +1,97 @@
+"""Append-only journal of accepted changes on top of a data file"""
+import json
+import os
+import zlib
+
+
+def checksum(file):
+    """Checksum of the content of a file"""
+    crc = 0
+    with open(file, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 16), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+class Journal(object):
+    """Journal with one change per line, the first line holds the checksum
+       of the data file the changes apply to"""
+    def __init__(self, file):
+        self.file = file
+        self.name = os.path.splitext(file)[0] + '.journal'
+        self.fp = None
+        self.entries = 0
+        self.size = 0  # length of the valid part of the journal
+
+    def read(self):
+        """Generate the (url, data) changes that apply to the data file"""
+        self.entries = 0
+        self.size = 0
+        if not os.path.exists(self.name):
+            return
+        with open(self.name, 'rb') as fp:
+            header = fp.readline()
+            if not header.endswith(b'\n') or json.loads(
+                    header.decode()).get('base') != checksum(self.file):
+                return  # already folded into the data file
+            self.size = len(header)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break  # torn write of the last change
+                change = json.loads(line.decode())
+                self.entries += 1
+                self.size += len(line)
+                data = change.get('data')
+                yield change['url'], '' if data is None else json.dumps(data)
+
+    def _start(self):
+        """Start a new journal on the current data file"""
+        if self.fp:
+            self.fp.close()
+        self.fp = open(self.name, 'w')
+        self._append({'base': checksum(self.file)})
+        self.entries = 0
+
+    def _append(self, obj, sync=True):
+        """Write a line, wait until it is on disk unless told otherwise"""
+        self.fp.write(json.dumps(obj, separators=(',', ':')) + '\n')
+        if sync:
+            self.sync()
+
+    def sync(self):
+        """Wait until the written changes are on disk"""
+        if self.fp:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def open(self):
+        """Continue the journal after reading it or start a fresh one"""
+        if self.entries == 0:
+            self._start()
+        else:
+            self.fp = open(self.name, 'a')
+            self.fp.truncate(self.size)
+
+    def write(self, url, data, sync=True):
+        """Append an accepted change, without sync it is only durable after
+           the next call to sync"""
+        if self.fp is None:
+            self.open()
+        data = json.loads(data) if data else None
+        self._append({'url': url, 'data': data}, sync)
+        self.entries += 1
+
+    def compact(self, general):
+        """Fold the journal into a fresh data file"""
+        new = self.file + '.new'
+        general.output(new)
+        with open(new) as fp:
+            os.fsync(fp.fileno())
+        os.replace(new, self.file)
+        self._start()
+
+    def close(self):
+        """Close the journal file"""
+        if self.fp:
+            self.fp.close()
+            self.fp = None
@@ -0,0 +1,46 @@
+"""Option lists with the records of a table to choose a relation from"""
+from rbtree import RBDict
+
+
+class OptionList(object):
+    """Id and label of the records of a table in key order. The Store
+       updates it on every store and remove, the HTML options and the JSON
+       values are only joined again after a change."""
+    def __init__(self, records):
+        self.options = RBDict()  # key to (id, label, html option)
+        self.html = None
+        self.values = None
+        for rec in records:
+            self.add(rec)
+
+    def add(self, rec):
+        """Add or replace the option of a stored record"""
+        key = rec.get_id()
+        label = rec.show()
+        self.options[rec.get_key()] = (
+            key, label, '<option value="' + key + '">' + label + '</option>\n')
+        self.html = None
+        self.values = None
+
+    def remove(self, rec):
+        """Remove the option of a record that is removed or changed"""
+        if rec.get_key() in self.options:
+            del self.options[rec.get_key()]
+            self.html = None
+            self.values = None
+
+    def get_html(self, selected=None):
+        """HTML options, the option with the id in selected is selected"""
+        if self.html is None:
+            self.html = ''.join(opt[2] for opt in self.options)
+        if not selected:
+            return self.html
+        option = '<option value="' + selected + '"'
+        return self.html.replace(option + '>', option + ' selected>', 1)
+
+    def get_values(self):
+        """List of {'key': id, 'value': label}, do not change it"""
+        if self.values is None:
+            self.values = [
+                {'key': opt[0], 'value': opt[1]} for opt in self.options]
+        return self.values
@@ -0,0 +1,231 @@
+"""Queries on the records of a table with filters, sorting and projection"""
+import heapq
+import operator
+from collections import OrderedDict
+
+from fields import Relation, Set, _index_value
+
+OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'in')
+RANGES = ('<', '<=', '>', '>=')
+BOUNDS = ('=',) + RANGES  # operators that limit a range of the keys
+COMPARE = {
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def _sort_value(val):
+    """Comparable value of a field, empty values first"""
+    if val is None:
+        return False, None
+    if isinstance(val, tuple):
+        return True, val
+    get_key = getattr(val, 'get_key', None)
+    return True, get_key() if get_key else val
+
+
+def _match(val, cond):
+    """Test a field value against a list of (operator, value) conditions"""
+    for oper, want in cond:
+        if oper == '=':
+            found = val is want or val == want
+        elif oper == '!=':
+            found = val is not want and val != want
+        elif oper == 'in':
+            found = val in want
+        else:
+            found = val is not None and want is not None and \
+                COMPARE[oper](val, want)
+        if not found:
+            return False
+    return True
+
+
+class Query(object):
+    """Plan and run a query on a table. The data holds "where" with per
+       field a value or {operator: value}, "sort" with field names, a
+       leading '-' sorts descending, "fields" to show and "limit"."""
+    def __init__(self, general, clazz, data):
+        self.general = general
+        self.clazz = clazz
+        self.where = OrderedDict()
+        for name, cond in sorted((data.get('where') or {}).items()):
+            self.where[name] = self._condition(name, cond)
+        self.sort = []
+        for name in data.get('sort') or []:
+            desc = name.startswith('-')
+            self._field(name[1:] if desc else name)
+            self.sort.append((name[1:] if desc else name, desc))
+        self.fields = data.get('fields') or [
+            fld.name for fld in clazz.fields if not isinstance(fld, Set)]
+        for name in self.fields:
+            self._field(name)
+        self.limit = data.get('limit')
+        if self.limit is not None and (
+                not isinstance(self.limit, int) or self.limit < 0):
+            raise ValueError("Invalid limit '" + str(self.limit) + "'")
+        keys = getattr(clazz, 'keys')
+        self.order = keys  # fields the walk of the plan is sorted on
+        self.index = None
+        if keys and any(
+                oper in BOUNDS for oper, _ in self.where.get(keys[0], [])):
+            self.plan = 'key range'
+        elif not self._plan_index():
+            self.plan = 'scan'
+
+    def _field(self, name):
+        """Definition of a field that can be queried"""
+        names = getattr(self.clazz, 'field_on_name')
+        if name not in names or isinstance(names[name], Set):
+            raise ValueError("Unknown field '" + name + "'")
+        return names[name]
+
+    def _condition(self, name, cond):
+        """List of (operator, value) with values read from the request"""
+        fld = self._field(name)
+        if not isinstance(cond, dict):
+            cond = {'=': cond}
+        res = []
+        for oper, value in sorted(cond.items()):
+            if oper not in OPERATORS:
+                raise ValueError("Unknown operator '" + oper + "'")
+            if isinstance(fld, Relation) and oper in RANGES:
+                raise ValueError(
+                    "Only = != and in on relation '" + name + "'")
+            if oper == 'in':
+                if not isinstance(value, list):
+                    raise ValueError("Expect a list for in on '" + name + "'")
+                value = [None if v is None else fld.read(v) for v in value]
+            elif value is not None:
+                value = fld.read(value)
+            res.append((oper, value))
+        return res
+
+    def _equal(self, name):
+        """Value of an equality condition on a field or KeyError"""
+        for oper, value in self.where.get(name, []):
+            if oper == '=':
+                return value
+        raise KeyError(name)
+
+    def _plan_index(self):
+        """Use the secondary index with the most leading fields that have
+           an equality condition, returns if one was found"""
+        store = getattr(self.clazz, 'data_store')
+        idx = None
+        prefix = []
+        for found in getattr(self.clazz, 'indexes', []):
+            values = []
+            for name in found.keys:
+                try:
+                    values.append(self._equal(name))
+                except KeyError:
+                    break
+            if len(values) > len(prefix):
+                idx, prefix = found, values
+        if idx is None:
+            return False
+        names = getattr(self.clazz, 'field_on_name')
+        self.plan = 'index ' + idx.name
+        self.order = idx.keys[:len(prefix)]
+        self.index = store.indexes[(self.clazz, idx.name)], tuple(
+            _index_value(names[k], v) for k, v in zip(idx.keys, prefix))
+        return True
+
+    def _walk_key(self):
+        """Walk the primary key range of the set of the table, the whole
+           set without a bound on the first key"""
+        records = getattr(self.general, self.clazz.path)
+        names = getattr(self.clazz, 'field_on_name')
+        prefix = []
+        bound = None
+        for name in getattr(self.clazz, 'keys'):
+            try:
+                val = self._equal(name)
+            except KeyError:
+                bound = name
+                break
+            if val is None:
+                return
+            prefix.append(_sort_value(val)[1] if isinstance(
+                names[name], Relation) else val)
+        prefix = tuple(prefix)
+        lower = None
+        upper = []
+        for oper, val in self.where.get(bound, []):
+            if isinstance(names[bound], Relation) or val is None:
+                continue
+            if oper in ('>', '>=') and (lower is None or val > lower):
+                lower = val
+            elif oper in ('<', '<='):
+                upper.append((oper, val))
+        from_key = prefix + (lower,) if lower is not None else None
+        pos = len(prefix)
+        for key, rec in records.range(from_key, None, prefix or None):
+            if upper and not _match(key[pos], upper):
+                return  # beyond the upper bound of the range
+            yield rec
+
+    def _walk_index(self):
+        """Walk the matching part of a secondary index"""
+        index, prefix = self.index
+        for _, rec in index.prefix(prefix):
+            yield rec
+
+    def records(self):
+        """Lazily generate the records that match all conditions"""
+        if self.index is None:
+            walk = self._walk_key()
+        else:
+            walk = self._walk_index()
+        where = list(self.where.items())
+        for rec in walk:
+            if all(_match(getattr(rec, name), cond) for name, cond in where):
+                yield rec
+
+    def _sorted(self):
+        """Records in the requested order, sorted only when the walk of
+           the plan is not in that order already"""
+        order = [name for name, _ in self.sort]
+        if not any(desc for _, desc in self.sort) and \
+                order == list(self.order[:len(order)]):
+            return self.records()
+        if self.limit is not None and \
+                len(set(desc for _, desc in self.sort)) == 1:
+            # only keep the first records, one more to tell there are more
+            pick = heapq.nlargest if self.sort[0][1] else heapq.nsmallest
+            return iter(pick(self.limit + 1, self.records(), key=lambda rec: [
+                _sort_value(getattr(rec, name)) for name in order]))
+        res = list(self.records())
+        for name, desc in reversed(self.sort):
+            res.sort(key=lambda rec, n=name: _sort_value(getattr(rec, n)),
+                     reverse=desc)
+        return iter(res)
+
+    def show(self, rec):
+        """Projection of a record on the requested fields"""
+        res = OrderedDict()
+        res['key'] = rec.get_id()
+        names = getattr(self.clazz, 'field_on_name')
+        for name in self.fields:
+            val = getattr(rec, name)
+            if val is None:
+                res[name] = None
+            elif isinstance(names[name], Relation):
+                res[name] = val.get_id()
+            else:
+                res[name] = names[name].write(val)
+        return res
+
+    def run(self):
+        """Result with the plan used, the records and if there are more"""
+        show = OrderedDict()
+        show['plan'] = self.plan
+        ls = []
+        more = False
+        for rec in self._sorted():
+            if self.limit is not None and len(ls) == self.limit:
+                more = True
+                break
+            ls.append(self.show(rec))
+        show['records'] = ls
+        show['more'] = more
+        return show
@@ -1,32 +1,298 @@
-"""Simple tree-like structure"""
-import copy
+"""Sorted dictionary on a left leaning red-black tree"""
+
+
+class Versions(object):
+    """Generations of the trees of a store. Pinning a snapshot starts a new
+       generation, a change copies the nodes of older generations instead
+       of changing them, so the pinned trees stay as they were."""
+    __slots__ = 'current', 'live'
+
+    def __init__(self):
+        self.current = 0
+        self.live = {}  # pinned generation to its number of snapshots
+
+    def pin(self):
+        """Pin the current state of all trees, return its generation"""
+        gen = self.current
+        self.live[gen] = self.live.get(gen, 0) + 1
+        self.current = gen + 1
+        return gen
+
+    def release(self, gen):
+        """Release a pinned generation"""
+        if self.live[gen] > 1:
+            self.live[gen] -= 1
+        else:
+            del self.live[gen]
+
+    def pinned(self):
+        """The currently pinned generations"""
+        return list(self.live)
+
+
+class Node(object):
+    """Node inside the tree"""
+    __slots__ = 'key', 'value', 'left', 'right', 'red', 'gen'
+
+    def __init__(self, key, value, gen):
+        self.key = key
+        self.value = value
+        self.left = None
+        self.right = None
+        self.red = True
+        self.gen = gen
+
+
+def _own(node, gen):
+    """Copy of a node of an older generation to change instead of it"""
+    res = Node(node.key, node.value, gen)
+    res.left = node.left
+    res.right = node.right
+    res.red = node.red
+    return res
+
+
+def _is_red(node):
+    """Test if a node exists and is red, empty leaves are black"""
+    return node is not None and node.red
+
+
+def _rotate_left(node, gen):
+    """Make a right leaning red link lean to the left"""
+    res = node.right
+    if res.gen != gen:
+        res = _own(res, gen)
+    node.right = res.left
+    res.left = node
+    res.red = node.red
+    node.red = True
+    return res
+
+
+def _rotate_right(node, gen):
+    """Make a left leaning red link lean to the right"""
+    res = node.left
+    if res.gen != gen:
+        res = _own(res, gen)
+    node.left = res.right
+    res.right = node
+    res.red = node.red
+    node.red = True
+    return res
+
+
+def _flip_colors(node, gen):
+    """Split or join a temporary 4-node"""
+    node.red = not node.red
+    if node.left.gen != gen:
+        node.left = _own(node.left, gen)
+    node.left.red = not node.left.red
+    if node.right.gen != gen:
+        node.right = _own(node.right, gen)
+    node.right.red = not node.right.red
+
+
+def _balance(node, gen):
+    """Restore the red-black invariants on the way up"""
+    if _is_red(node.right) and not _is_red(node.left):
+        node = _rotate_left(node, gen)
+    if _is_red(node.left) and _is_red(node.left.left):
+        node = _rotate_right(node, gen)
+    if _is_red(node.left) and _is_red(node.right):
+        _flip_colors(node, gen)
+    return node
+
+
+def _move_red_left(node, gen):
+    """Make node.left or one of its children red before descending left"""
+    _flip_colors(node, gen)
+    if _is_red(node.right.left):
+        node.right = _rotate_right(node.right, gen)
+        node = _rotate_left(node, gen)
+        _flip_colors(node, gen)
+    return node
+
+
+def _move_red_right(node, gen):
+    """Make node.right or one of its children red before descending right"""
+    _flip_colors(node, gen)
+    if _is_red(node.left.left):
+        node = _rotate_right(node, gen)
+        _flip_colors(node, gen)
+    return node
+
+
+def _insert(node, key, value, gen):
+    """Insert or replace a key below node, return the new subtree root"""
+    if node is None:
+        return Node(key, value, gen)
+    if node.gen != gen:
+        node = _own(node, gen)
+    if key < node.key:
+        node.left = _insert(node.left, key, value, gen)
+    elif node.key < key:
+        node.right = _insert(node.right, key, value, gen)
+    else:
+        node.value = value
+        return node
+    return _balance(node, gen)
+
+
+def _delete_min(node, gen):
+    """Remove the smallest node below node, return the new subtree root"""
+    if node.left is None:
+        return None
+    if node.gen != gen:
+        node = _own(node, gen)
+    if not _is_red(node.left) and not _is_red(node.left.left):
+        node = _move_red_left(node, gen)
+    node.left = _delete_min(node.left, gen)
+    return _balance(node, gen)
+
+
+def _delete(node, key, gen):
+    """Remove an existing key below node, return the new subtree root"""
+    if node.gen != gen:
+        node = _own(node, gen)
+    if key < node.key:
+        if not _is_red(node.left) and not _is_red(node.left.left):
+            node = _move_red_left(node, gen)
+        node.left = _delete(node.left, key, gen)
+    else:
+        if _is_red(node.left):
+            node = _rotate_right(node, gen)
+        if not key < node.key and not node.key < key and node.right is None:
+            return None
+        if not _is_red(node.right) and not _is_red(node.right.left):
+            node = _move_red_right(node, gen)
+        if not key < node.key and not node.key < key:
+            low = node.right
+            while low.left is not None:
+                low = low.left
+            node.key = low.key
+            node.value = low.value
+            node.right = _delete_min(node.right, gen)
+        else:
+            node.right = _delete(node.right, key, gen)
+    return _balance(node, gen)
 
 
 class DictIter(object):
     """Iterator through the tree"""
-    __slots__ = 'data', 'keys', 'index'
+    __slots__ = 'tree', 'stack', 'last', 'version'
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.stack = []
+        self.last = None
+        self.version = tree.version
+        self._descend(tree.root)
+
+    def _descend(self, node):
+        """Push the left spine of a subtree"""
+        while node is not None:
+            self.stack.append(node)
+            node = node.left
+
+    def _seek(self):
+        """The tree changed: continue after the last returned key"""
+        self.stack = []
+        self.version = self.tree.version
+        node = self.tree.root
+        if self.last is None:
+            self._descend(node)
+            return
+        while node is not None:
+            if self.last < node.key:
+                self.stack.append(node)
+                node = node.left
+            else:
+                node = node.right
 
-    def __init__(self, data):
-        self.data = data
-        self.keys = sorted(data.keys())
-        self.index = -1  # ready to iterate on the next() call
+    def _next_node(self):
+        """Return the next node in key order"""
+        if self.version != self.tree.version:
+            self._seek()
+        stack = self.stack
+        if not stack:
+            self.tree = None
+            raise StopIteration
+        node = stack.pop()
+        child = node.right
+        while child is not None:
+            stack.append(child)
+            child = child.left
+        self.last = node.key
+        return node
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
         """ Return the next item in the container
             Once we go off the list we stay off even if the list changes
         """
-        self.index += 1
-        if self.index >= len(self.keys):
+        if self.tree is None:
+            raise StopIteration
+        return self._next_node().value
+
+
+class RangeIter(DictIter):
+    """Iterator through the (key, value) pairs of a part of the tree"""
+    __slots__ = 'from_key', 'to_key', 'prefix'
+
+    def __init__(self, tree, from_key=None, to_key=None, prefix=None):
+        DictIter.__init__(self, tree)
+        if prefix is not None and (from_key is None or from_key < prefix):
+            from_key = prefix
+        self.from_key = from_key
+        self.to_key = to_key
+        self.prefix = prefix
+        if from_key is not None:
+            self._seek()
+
+    def _seek(self):
+        """Start at the first key not below from_key"""
+        if self.last is not None or self.from_key is None:
+            DictIter._seek(self)
+            return
+        self.stack = []
+        self.version = self.tree.version
+        node = self.tree.root
+        while node is not None:
+            if node.key < self.from_key:
+                node = node.right
+            else:
+                self.stack.append(node)
+                node = node.left
+
+    def __next__(self):
+        """Return the next key and value until the end of the range"""
+        if self.tree is None:
             raise StopIteration
-        return self.data[self.keys[self.index]]
+        node = self._next_node()
+        key = node.key
+        if (self.to_key is not None and not key < self.to_key) or (
+                self.prefix is not None and
+                key[:len(self.prefix)] != self.prefix):
+            self.tree = None
+            raise StopIteration
+        return key, node.value
 
 
 class RBDict(object):
-    """Sorted dictionary"""
-    __slots__ = 'data', 'changed'
+    """Sorted dictionary, with versions it keeps the trees of the pinned
+       generations"""
+    __slots__ = 'root', 'size', 'version', 'changed', 'gen', 'history', \
+        'versions'
 
-    def __init__(self, initial=None, changes=False):
-        self.data = {}
+    def __init__(self, initial=None, changes=False, versions=None):
+        self.root = None
+        self.size = 0
+        self.version = 0
+        self.versions = versions
+        self.gen = versions.current if versions else 0  # of the last change
+        self.history = []  # (last generation, root, size) while pinned
         if changes:
             self.changed = {}
         else:
@@ -40,12 +306,14 @@ class RBDict(object):
         self.changed = {} if remember_changes else None
 
     def changes(self):
-        """Get the list of changes with old and new value, clear the changes"""
-        if self.changes is None:
+        """Get the list of changes with old and new value, clear the changes.
+           A changed record is removed and stored again: its old value is
+           the record itself, its fields are in the undo log of the Store."""
+        if self.changed is None:
             raise AttributeError("No change recoding supported on this Set")
         res = [(
             self.changed[chkey],
-            self.data[chkey] if chkey in self.data else None
+            self.get(chkey)
         ) for chkey in sorted(self.changed.keys())]
         self.changed.clear()
         return res
@@ -54,58 +322,150 @@ class RBDict(object):
         """Return if there are changes in this rbtree"""
         return self.changed is not None and len(self.changed) > 0
 
-    def restore(self, key):
-        """Try to restore the old changed record"""
-        if self.changed is not None and key in self.changed:
-            self.data[key] = self.changed[key]
-            del self.changed[key]
+    def _keep(self):
+        """Before a change: keep the root for the pinned snapshots that
+           still see it, return the generation of the change"""
+        versions = self.versions
+        if versions is None:
+            return self.gen
+        current = versions.current
+        if self.gen == current:
+            if self.history and not versions.live:
+                self.history = []  # all snapshots are released
+            return current
+        pinned = versions.pinned()
+        if pinned:
+            history = [old for old in self.history if old[0] >= min(pinned)]
+            if max(pinned) >= self.gen:
+                history.append((current - 1, self.root, self.size))
+            self.history = history
+        elif self.history:
+            self.history = []
+        self.gen = current
+        return current
+
+    def at(self, gen):
+        """Read-only view of the tree as it was when gen was pinned"""
+        root = self.root  # before the history that a change extends first
+        size = self.size
+        for last, old_root, old_size in self.history:
+            if last >= gen:
+                root = old_root
+                size = old_size
+                break
+        return FrozenDict(root, size)
+
+    def _find(self, key):
+        """Return the node holding key or None"""
+        node = self.root
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            elif node.key < key:
+                node = node.right
+            else:
+                return node
+        return None
+
+    def _put(self, key, value):
+        """Insert or replace a key without change tracking"""
+        gen = self._keep()
+        node = self._find(key)
+        if node is not None and node.gen == gen:
+            node.value = value
+            return
+        self.root = _insert(self.root, key, value, gen)
+        self.root.red = False
+        if node is None:
+            self.size += 1
+            self.version += 1
 
     def __getitem__(self, key):
-        return self.data[key]
+        node = self._find(key)
+        if node is None:
+            raise KeyError(key)
+        return node.value
 
     def __setitem__(self, key, value):
-        if self.changed is not None and key not in self.changed:
-            if key in self.data:
+        if self.changed is not None:
+            if key in self:
                 raise ValueError("Remove an item before storing a changed one")
-            self.changed[key] = None
-        self.data[key] = value
+            if key not in self.changed:
+                self.changed[key] = None
+        self._put(key, value)
 
     def __delitem__(self, key):
+        node = self._find(key)
+        if node is None:
+            raise KeyError(key)
         if self.changed is not None and key not in self.changed:
-            if key in self.data:
-                self.changed[key] = copy.copy(self.data[key])
-        del self.data[key]
+            self.changed[key] = node.value
+        gen = self._keep()
+        if self.root.gen != gen:
+            self.root = _own(self.root, gen)
+        if not _is_red(self.root.left) and not _is_red(self.root.right):
+            self.root.red = True
+        self.root = _delete(self.root, key, gen)
+        if self.root is not None:
+            self.root.red = False
+        self.size -= 1
+        self.version += 1
 
     def get(self, key, default=None):
         """Get a key from the dictionary with a default"""
-        if key in self.data:
-            return self.data[key]
-        return default
+        node = self._find(key)
+        if node is None:
+            return default
+        return node.value
+
+    def _nodes(self):
+        """Generate all nodes in key order"""
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
 
     def __iter__(self):
-        return DictIter(self.data)
+        return DictIter(self)
 
     def __len__(self):
-        return len(self.data)
+        return self.size
+
+    def range(self, from_key=None, to_key=None, prefix=None):
+        """Lazily iterate the items with from_key <= key < to_key, when
+           given only the keys starting with prefix"""
+        return RangeIter(self, from_key, to_key, prefix)
+
+    def prefix(self, prefix):
+        """Lazily iterate the items with a key starting with prefix"""
+        return RangeIter(self, prefix=prefix)
 
     def keys(self):
         """Return all keys"""
-        return sorted(self.data.keys())
+        return [node.key for node in self._nodes()]
 
     def values(self):
         """Return all values"""
-        return [self.data[k] for k in self.keys()]
+        return [node.value for node in self._nodes()]
 
     def items(self):
         """Return all items"""
-        return [(k, self.data[k]) for k in self.keys()]
+        return [(node.key, node.value) for node in self._nodes()]
 
     def __contains__(self, key):
-        return key in self.data
+        return self._find(key) is not None
 
     def clear(self):
         """delete all entries"""
-        self.data.clear()
+        self._keep()
+        self.root = None
+        self.size = 0
+        self.version += 1
         if self.changed is not None:
             self.changed.clear()
 
@@ -125,8 +485,27 @@ class RBDict(object):
         for k, v in self.items():
             if len(ls) > 1:
                 ls.append(', ')
-            ls.append(k)
+            ls.append(str(k))
             ls.append('=')
             ls.append(str(v))
         ls.append('}')
         return ''.join(ls)
+
+
+class FrozenDict(RBDict):
+    """Read-only view on a pinned version of a tree"""
+    __slots__ = ()
+
+    def __init__(self, root, size):
+        RBDict.__init__(self)
+        self.root = root
+        self.size = size
+
+    def _put(self, key, value):
+        raise ValueError("Cannot change a snapshot")
+
+    def __delitem__(self, key):
+        raise ValueError("Cannot change a snapshot")
+
+    def clear(self):
+        raise ValueError("Cannot change a snapshot")
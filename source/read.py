@@ -1,10 +1,23 @@
 """Import old style data"""
+import mmap
 import os
+import re
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 from tables import tables_init
 from server import Server
-from fields import Set, Relation, Store
+from journal import Journal
+from snapshot import load_snapshot, write_snapshot
+from fields import Set, Relation
+from store import Store
+
+WHITESPACE = re.compile(r"[\n\t \b]*")
+FIELD = re.compile(r"[a-z_]*")
+VALUE = re.compile(r"[^,\\]*(?:\\[,}]?[^,\\]*)*")
+RELATION_VALUE = re.compile(r"[^,}\\]*(?:\\[,}]?[^,}\\]*)*")
+ESCAPED = re.compile(r"\\([,}])")
+SET_START = re.compile(r"(?:^|, |& )([a-z_]+)=\[$")
 
 
 class Unresolved(object):
@@ -16,6 +29,29 @@ class Unresolved(object):
         self.line_nr = line_nr  # the line where the relation was encountered
 
 
+def _key_pending(rec):
+    """Test if a relation in the key of a record is not resolved yet"""
+    for key in getattr(rec, 'keys'):
+        if isinstance(rec.field(key), Relation) and \
+                getattr(rec, key, None) is None:
+            return True
+    return False
+
+
+def _raw_key(rec, raw):
+    """Key of a record with the keys of the relations that are not
+       resolved taken from their data in the file"""
+    ls = []
+    for name in rec.key_fields():
+        val = getattr(rec, name)
+        if val is None:
+            val = raw.get(name)
+        elif isinstance(rec.field(name), Relation):
+            val = val.get_key()
+        ls.append(val)
+    return tuple(ls)
+
+
 class Scanner(object):
     """Define the global fields of the file scanner"""
     def __init__(self, fp):
@@ -25,6 +61,12 @@ class Scanner(object):
         self.pos = 0
         self.stop = not self._next_line()
         self.unresolved = []
+        self.keep = None  # names of the top level Sets to store, None: all
+        self.dropping = False  # reading a record of a Set not in keep
+        self.resolving = True
+        self.deferring = False  # collect all relations as unresolved
+        self.unstored = []  # records with a key waiting on a relation
+        self.raw_keys = {}  # id of a record to the keys of its relations
 
     def _next(self):
         """Return the next character found or '' on end of line"""
@@ -63,63 +105,55 @@ class Scanner(object):
 
     def _skip_whitespace(self):
         """Skip whitespace and comments"""
-        while self._has_next('\n', '\t', ' ', '\b'):
-            pass
-        if self._next() == '#':  # comment found
+        self.pos = WHITESPACE.match(self.line, self.pos).end()
+        if self.line.startswith('#', self.pos):  # comment found
             self.pos = len(self.line)
 
     def _scan_indent(self, indent):
         """Check for the correct indentation"""
         self.pos = 0
-        for _ in range(indent * 2):
-            if self._next() == '#':
-                self.pos = len(self.line)
-                return
-            self._expect(' ', "Expect correct indentation")
+        if self.line.startswith('  ' * indent):
+            self.pos = indent * 2
+        else:
+            for _ in range(indent * 2):
+                if self._next() == '#':
+                    self.pos = len(self.line)
+                    return
+                self._expect(' ', "Expect correct indentation")
         if self._next() == '#':
             self.pos = len(self.line)
 
     def _scan_field(self):
         """Read a field from the file"""
         self._skip_whitespace()
-        field = ''
-        while 'a' <= self._next() <= 'z' or self._next() == '_':
-            field += self._next()
-            self.pos += 1
-        if len(field) == 0:
+        end = FIELD.match(self.line, self.pos).end()
+        if end == self.pos:
             raise ValueError("Expected a field")
+        field = self.line[self.pos:end]
+        self.pos = end
         return field
 
     def _scan_value(self, relation=False):
         """Read a value from the file"""
-        value = ''
-        test = [',', '}'] if relation else [',']
-        while self._next() not in test:
-            if self.pos < len(self.line) - 1 and \
-                    self.line[self.pos] == '\\' and \
-                    self.line[self.pos + 1] in [',', '}']:
-                value += self.line[self.pos + 1]
-                self.pos += 2
-            elif self.pos < len(self.line):
-                value += self.line[self.pos]
-                self.pos += 1
-            else:
-                break
+        match = (RELATION_VALUE if relation else VALUE).match(
+            self.line, self.pos)
+        self.pos = match.end()
+        value = match.group()
+        if '\\' in value:
+            value = ESCAPED.sub(r"\1", value)
         return value
 
     def _scan_multi_line(self, rec, fld, indent):
         """Scan a multi-line string"""
         self._next_line()
-        res = ""
+        res = []
         while self.line.startswith('  ' * indent):
-            if res:
-                res += "\n"
-            res += self.line[indent * 2:]
+            res.append(self.line[indent * 2:])
             self._next_line()
-        setattr(rec, fld.name, res)
+        setattr(rec, fld.name, "\n".join(res))
 
-    def _scan_set(self, rec, fld, indent):
-        """Scan a set of sub records"""
+    def _scan_set(self, rec, fld, indent, path):
+        """Scan a set of sub records, generate each finished record"""
         self._skip_whitespace()
         self._expect('[', "Expect '[' at the start of a Set")
         if self._has_next(']'):  # empty set
@@ -132,8 +166,24 @@ class Scanner(object):
             if self.line.startswith('  ' * (indent - 1) + "]"):
                 break
             sub = fld.related(rec)
-            if self._read_record(sub, indent):
+            drop = self.keep is not None and indent == 1 and \
+                fld.name not in self.keep
+            if indent == 1:
+                self.dropping = drop
+            found = yield from self._read_record(
+                sub, indent, path + (fld.name,))
+            raw = self.raw_keys.pop(id(sub), None)
+            if not found:
+                continue
+            if raw is not None and not self.deferring and _key_pending(sub):
+                sub.cached_key = _raw_key(sub, raw)  # not on a shared key
+            if self.deferring and _key_pending(sub):
+                self.unstored.append(sub)  # store once the key is known
+            elif not drop:
                 sub.store()
+            yield path + (fld.name,), sub
+            if drop:  # forget the indexes of the sub records
+                getattr(sub, 'data_store').remove_indexes(sub)
         if self.stop:
             raise ValueError("Expect ']' after a set")
         self.pos = 2 * indent - 1
@@ -153,15 +203,26 @@ class Scanner(object):
                     continue
                 self._expect('}', "Expect a '}' after relation data")
                 break
-            found = fld.find(data)
-            if found is None:
+            if fld.name in getattr(rec, 'keys'):
+                self.raw_keys.setdefault(id(rec), {})[fld.name] = \
+                    fld.key(data)
+            if not self.resolving:
+                return
+            found = None if self.deferring else fld.find(data)
+            if found is not None:
+                getattr(rec, 'data_store').relate(rec, fld.name, found)
+            elif not self.dropping and self._kept(fld.related):
                 self.unresolved.append(
                     Unresolved(rec, fld.name, data, self.line_nr))
-            else:
-                setattr(rec, fld.name, fld.find(data))
 
-    def _read_record(self, rec, indent):
-        """Create a record from the new style file"""
+    def _kept(self, related):
+        """Test if the records of a table are stored while reading"""
+        return self.keep is None or not related.path or \
+            related.path in self.keep
+
+    def _read_record(self, rec, indent, path):
+        """Create a record from the new style file, generate the finished
+           sub records and return if a record was found"""
         self._scan_indent(indent)
         while self.pos == len(self.line):
             if not self._next_line() or \
@@ -174,7 +235,7 @@ class Scanner(object):
             self._expect('=', "Expect a '=' after a field")
             fld = rec.field(field)
             if isinstance(fld, Set):
-                self._scan_set(rec, fld, indent + 1)
+                yield from self._scan_set(rec, fld, indent + 1, path)
             elif isinstance(fld, Relation):
                 self._scan_relation(rec, fld)
             elif self.pos == len(self.line):
@@ -199,20 +260,51 @@ class Scanner(object):
     def read(self, general):
         """Read data from a file"""
         try:
-            self._read_record(general, 0)
+            for _ in self._read_record(general, 0, ()):
+                pass
         except ValueError as exc:
             raise ValueError(str(exc) + " on line " + str(self.line_nr))
 
+    def records(self, general, keep=(), resolve=True, defer=False):
+        """Generate (path, record) as soon as a record at any depth is read.
+           Only the top level Sets named in keep are stored in general (None
+           stores all), so memory stays bounded by the largest top level
+           record. Relations are only looked up when resolve is set; forward
+           references between kept records are then resolved after the last
+           record, relations of or to dropped records are left empty when
+           not found directly. A sub record with a relation in its key that
+           is not resolved is stored on the key written in the file. With
+           defer all relations are left in self.unresolved for the
+           caller."""
+        self.keep = keep
+        self.resolving = resolve
+        self.deferring = defer
+        try:
+            yield from self._read_record(general, 0, ())
+        except ValueError as exc:
+            raise ValueError(str(exc) + " on line " + str(self.line_nr))
+        if resolve and not defer:
+            self.resolve()
+
     def resolve(self):
-        """Try to resolve the previous unresolved relations"""
+        """Resolve the unresolved relations in one pass over the hash
+           indexes of the tables"""
+        fields = {}
+        found = []
         for rel in self.unresolved:
-            fld = rel.obj.field(rel.fldName)
-            found = fld.find(rel.data)
-            if found is None:
+            fld = fields.get((rel.obj.__class__, rel.fldName))
+            if fld is None:
+                fld = rel.obj.field(rel.fldName)
+                fields[(rel.obj.__class__, rel.fldName)] = fld
+            rec = fld.find(rel.data)
+            if rec is None:
                 raise ValueError(
                     "Unresolved relation " + fld.related.__name__ + " " +
-                    str(rel.data) + " on line " + str(self.line_nr))
-            setattr(rel.obj, rel.fldName, found)
+                    str(rel.data) + " on line " + str(rel.line_nr))
+            found.append(rec)
+        for rel, rec in zip(self.unresolved, found):
+            getattr(rel.obj, 'data_store').relate(rel.obj, rel.fldName, rec)
+        self.unresolved = []
 
 
 def do_scan(fp, general):
@@ -229,6 +321,108 @@ def scan_file(filename, general):
     fp.close()
 
 
+def stream_file(filename, general, keep=(), resolve=True, use_mmap=False):
+    """Generate the (path, record) pairs of a data file without loading
+       all records"""
+    with open(filename, 'rb' if use_mmap else 'r') as fp:
+        if not use_mmap:
+            yield from Scanner(fp).records(general, keep, resolve)
+            return
+        mem = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lines = (line.decode() for line in iter(mem.readline, b''))
+            yield from Scanner(lines).records(general, keep, resolve)
+        finally:
+            mem.close()
+
+
+def split_blocks(lines, general, chunk_lines=50000):
+    """Split the lines of a data file in the top level lines and chunks of
+       whole records of the top level Sets: (set name, first line, lines)"""
+    sets = [fld.name for fld in general.fields if isinstance(fld, Set)]
+    top = []
+    chunks = []
+    body = None
+    name = None
+    start = line_nr = 0
+    for line_nr, line in enumerate(lines, 1):
+        if line.endswith('\n'):
+            line = line[:-1]
+        if body is None:
+            top.append(line)
+        elif line.startswith(']'):  # end of the set, keep the rest of the line
+            if body:
+                chunks.append((name, start, body))
+            top[-1] += line
+            body = None
+        elif len(body) >= chunk_lines and line.startswith('  ') and \
+                line[2:3] not in (' ', '&', ']', '#'):
+            chunks.append((name, start, body))
+            body = [line]
+            start = line_nr
+            continue
+        else:
+            body.append(line)
+            continue
+        match = SET_START.search(line)  # also after ']' of the Set before
+        if match and match.group(1) in sets:
+            name = match.group(1)
+            body = []
+            start = line_nr + 1
+    if not line_nr:  # an empty file has no top level lines
+        return [], []
+    if body is not None:
+        raise ValueError("Expect ']' after a set on line " + str(line_nr))
+    return top, chunks
+
+
+def _bind_versions(rec, versions):
+    """Let the Sets of a record and of its sub records keep the pinned
+       generations of a store"""
+    for fld in rec.fields:
+        if isinstance(fld, Set):
+            tree = getattr(rec, fld.name)
+            tree.versions = versions
+            for sub in tree:
+                _bind_versions(sub, versions)
+
+
+def scan_chunk(name, start, lines):
+    """Read the records of a chunk of a top level Set in a worker, all
+       relations are returned unresolved"""
+    general = tables_init(Store())
+    scan = Scanner(iter([name + '=['] + lines + [']']))
+    scan.line_nr = start - 1
+    recs = [rec for path, rec in scan.records(general, None, defer=True)
+            if len(path) == 1]
+    for rec in recs:
+        rec.parent = None  # do not send the worker data along
+        _bind_versions(rec, None)
+    return recs, scan.unresolved, scan.unstored
+
+
+def scan_file_parallel(filename, general, workers=None, chunk_lines=50000):
+    """Read the data file with the top level Sets parsed in parallel"""
+    with open(filename) as fp:
+        top, chunks = split_blocks(fp, general, chunk_lines)
+    Scanner(iter(top)).read(general)
+    resolver = Scanner(iter(()))
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(scan_chunk, *zip(*chunks)) if chunks else []
+        for recs, unresolved, unstored in results:
+            later = set(id(rec) for rec in unstored)
+            for rec in recs:
+                rec.parent = general
+                _bind_versions(rec, general.stored.generations)
+                if id(rec) not in later:
+                    rec.store()
+            resolver.unresolved.extend(unresolved)
+            resolver.unstored.extend(unstored)
+    resolver.resolve()
+    for rec in resolver.unstored:
+        rec.store()
+
+
 def reading(string):
     """Read data from a string instead of a file after clearing everything"""
     store = Store()
@@ -242,16 +436,22 @@ def main():
     file = '../data/game.dbr'
     store = Store()
     game = tables_init(store)
-    scan_file(file, game)
-    game.output('../data/game.new')
-    if os.system('/usr/bin/cmp -s ../data/game.dbr ../data/game.new'):
-        subprocess.Popen([
-            '/usr/bin/meld', '../data/game.dbr', '../data/game.new'])
-    else:
+    if not load_snapshot(file, game):
+        scan_file(file, game)
+        game.output('../data/game.new')
+        if os.system('/usr/bin/cmp -s ../data/game.dbr ../data/game.new'):
+            subprocess.Popen([
+                '/usr/bin/meld', '../data/game.dbr', '../data/game.new'])
+            return
         os.unlink('../data/game.new')
-        html_path = "../html"
-        serv = Server(game, html_path, file)
-        serv.start()
+        write_snapshot(file, game)
+    html_path = "../html"
+    journal = Journal(file)
+    serv = Server(game, html_path, file, journal)
+    if serv.replay():
+        journal.compact(game)
+        write_snapshot(file, game)
+    serv.start()
 
 
 if __name__ == "__main__":
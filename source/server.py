@@ -1,27 +1,34 @@
 """A server that allows a web application to get information about records
    and change them"""
 import asyncio
+import io
 import json
-import re
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 
+from websockets.exceptions import ConnectionClosed
 from websockets.server import serve
-from fields import Set, Enum, Relation
+from fields import Set, Enum, Relation, parse_id
+from cache import ResponseCache
+from commit import GroupCommit
+from encode import layout, chunks, CHUNK_SIZE
+from html import Writer
 import export
 import form
+from query import Query
 
-REGEX = re.compile(r",\n *\"", re.MULTILINE)
-REGEX2 = re.compile(r"{\n *", re.MULTILINE)
-REGEX3 = re.compile(r"\n *}", re.MULTILINE)
+MAX_MESSAGE = 1 << 24  # largest websocket message, as for a /bulk/ upload
 
 
-def layout(obj):
-    """JSON version of the data strucutre"""
-    res = json.dumps(obj, indent=2, separators=(',', ':'), sort_keys=True)
-    res = REGEX.sub(", \"", res)
-    res = REGEX2.sub("{", res)
-    res = REGEX3.sub("}", res)
-    return res
+def split_message(message):
+    """Request id, url and data of a message: an optional line with the id
+       that does not start with '/', the url and the data on the rest"""
+    req_id = None
+    if not message.startswith('/'):
+        req_id, _, message = message.partition("\n")
+    url, _, data = message.partition("\n")
+    return req_id, url, data
 
 
 def show_documentation():
@@ -32,15 +39,51 @@ def show_documentation():
             "use": "Get information about fields defined in the data set."
         },
         {"command": '/record/', "use": "Get data from records."},
+        {
+            "command": '/record/<table>/<prefix>|',
+            "use": "Get the records with keys starting with the prefix."
+        },
+        {
+            "command": '/query/<table>',
+            "use": "Get records with {\"where\": {field: value or " +
+                   "{operator: value}}, \"sort\": [field or -field], " +
+                   "\"fields\": [field], \"limit\": number}."
+        },
         {"command": '/write/', "use": "Write data to records."},
-        {"command": '/list/', "use": "HTML list of records."},
+        {
+            "command": '/bulk/',
+            "use": "Add many records from an array of {\"table\": name, " +
+                   "\"data\": fields}, or only the fields after " +
+                   "/bulk/<table>. The values of an item are added as " +
+                   "table item/<key>/values. Rows can also be given one " +
+                   "per line. A message holds at most 16MB, larger " +
+                   "uploads are sent as several messages that are each " +
+                   "committed, ?first=<n> numbers the rows of a message " +
+                   "from n. Errors are given per row."
+        },
+        {
+            "command": '/delete/',
+            "use": "Delete a record, {\"cascade\": true} also deletes " +
+                   "the records that relate to it."
+        },
+        {
+            "command": '/list/<table>?after=<key>&limit=<n>&stream=1',
+            "use": "HTML list with a page of records after the key, the " +
+                   "lines of a streamed list are sent while they are written."
+        },
+        {
+            "command": '/metrics/',
+            "use": "Batch sizes and latencies of the group commits " +
+                   "and the use of the response cache."
+        },
         {"command": '/form/', "use": "HTML form for a record."},
     ]
     return doc
 
 
-def field_values(fld, general):
-    """Get a dictionary with information and possible values of a field"""
+def field_values(fld, snap):
+    """Get a dictionary with information and possible values of a field
+       as they were when the snapshot was pinned"""
     info = OrderedDict()
     info['name'] = fld.name
     info['type'] = type(fld).__name__
@@ -50,13 +93,11 @@ def field_values(fld, general):
         ls = []
         if fld.allow_null:
             ls.append({'key': '', 'value': ''})
-        for rec in getattr(general, fld.related.path):
-            ls.append({'key': rec.get_id(), 'value': rec.show()})
-        info['values'] = ls
+        info['values'] = ls + snap.options(fld.related).get_values()
     return info
 
 
-def _change_record(clazz, rec, data, recset, key):
+def _change_record(clazz, rec, data):
     """Change a record in the data set"""
     show = OrderedDict()
     res = clazz.validate(clazz, data)  # validate data before changing
@@ -69,7 +110,6 @@ def _change_record(clazz, rec, data, recset, key):
         rec.imp(data, change=True)
     except ValueError as e:
         if e.args[0] == 'Remove an item before storing a changed one':
-            recset.restore(key)
             res = {}
             for fld_key in clazz.keys:
                 fld = clazz.field_on_name[fld_key]
@@ -84,14 +124,30 @@ def _change_record(clazz, rec, data, recset, key):
     return show
 
 
+def _row_error(row, message, fields=None):
+    """Error of a row of a bulk"""
+    show = OrderedDict()
+    show['row'] = row
+    show['message'] = message
+    if fields:
+        show['fields'] = fields
+    return show
+
+
 class Server(object):
     """Server that handles requests for data on records and record changes"""
-    def __init__(self, general, path, file):
+    def __init__(self, general, path, file, journal=None, window=0.01,
+                 batch=100, cache_size=256):
         self.loop = None
         self.server = None
         self.general = general
         self.path = path
         self.file = file
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(1)  # one request at a time
+        self.readers = ThreadPoolExecutor(4)  # renders of pinned snapshots
+        self.cache = ResponseCache(cache_size)
+        self.group = GroupCommit(self.commit, self.executor, window, batch)
         self.records = OrderedDict()
         gen_class = general.__class__
         self.records[gen_class.__name__.lower()] = gen_class
@@ -99,6 +155,17 @@ class Server(object):
             if isinstance(fld, Set):
                 self.records[fld.related.__name__.lower()] = fld.related
 
+    def _find(self, table, key, snap=None):
+        """Record of a table with the given id or None, with a snapshot the
+           record that had the id when pinned"""
+        clazz = self.records[table]
+        key = parse_id(clazz, key)
+        if key is None:
+            return None
+        if snap is not None:
+            return snap.table(clazz).get(key)
+        return getattr(self.general, clazz.path).get(key)
+
     def show_table(self):
         """Show a list of known tables"""
         tables = []
@@ -106,21 +173,31 @@ class Server(object):
             tables.append(tbl)
         return tables
 
-    def record_info(self, record):
-        """Show the content of a record"""
+    def record_info(self, record, snap):
+        """Show the content of a record as it was when pinned"""
         pos = record.find("/")
-        if pos <= 0 or pos == len(record) - 1:
+        if pos <= 0 or pos == len(record) - 1 or record.endswith('|'):
             ls = []
+            prefix = None
             if pos > 0:
+                prefix = record[pos + 1:]
                 record = record[:pos]
-            for rec in getattr(self.general, self.records[record].path):
+            records = snap.table(self.records[record])
+            if prefix:  # only the keys starting with this prefix
+                key = parse_id(self.records[record], prefix, prefix=True)
+                records = () if key is None else \
+                    (rec for _, rec in records.prefix(key))
+            for rec in records:
+                rec = snap.view(rec)
                 ls.append({'key': rec.get_id(), 'show': rec.show()})
             return ls
         show = OrderedDict()
         try:
             table = record[:pos]
-            records = getattr(self.general, self.records[table].path)
-            rec = records[record[pos + 1:]]
+            rec = self._find(table, record[pos + 1:], snap)
+            if rec is None:
+                raise KeyError(record[pos + 1:])
+            rec = snap.view(rec)
             show['title'] = type(rec).__name__ + " " + rec.show()
             show['record'] = table
             show['key'] = rec.get_id()
@@ -128,7 +205,7 @@ class Server(object):
             for fld in rec.fields:
                 if isinstance(fld, Set):
                     continue
-                info = field_values(fld, self.general)
+                info = field_values(fld, snap)
                 val = getattr(rec, fld.name)
                 if isinstance(fld, Relation) and val:
                     info['value'] = val.get_id()
@@ -143,13 +220,21 @@ class Server(object):
             key = record[pos + 1:]
             show['message'] = 'Unknown ' + record[:pos] + ' "' + key + '"'
             ls = []
-            for rec in getattr(self.general, self.records[record[:pos]].path):
-                ls.append(rec.get_id())
+            for rec in snap.table(self.records[record[:pos]]):
+                ls.append(snap.view(rec).get_id())
             show['keys'] = ls
         return show
 
-    def record_delete(self, record):
-        """Remove a record from the store"""
+    def record_query(self, table, data):
+        """Show the records of a table that match the query in data"""
+        if table not in self.records or not self.records[table].path:
+            raise KeyError(table)
+        data = json.loads(data) if data else {}
+        return Query(self.general, self.records[table], data).run()
+
+    def record_delete(self, record, data):
+        """Remove a record from the store, with {"cascade": true} also
+           remove all records that relate to it"""
         pos = record.find("/")
         show = OrderedDict()
         if pos <= 0 or pos == len(record) - 1:
@@ -158,26 +243,37 @@ class Server(object):
             return show
         table = record[:pos]
         key = record[pos + 1:]
-        records = getattr(self.general, self.records[table].path)
-        if key not in records:
+        rec = self._find(table, key)
+        if rec is None:
             return {
                 'action': 'error',
                 'message': 'Unknown ' + table + ' "' + key + '"'}
-        rec = records[key]
-        problem = rec.removable(self.general)
+        cascade = bool(data) and json.loads(data).get('cascade', False)
+        problem = None if cascade else rec.removable(self.general)
         if problem is not None:
             show['action'] = 'error'
             for k, v in problem.items():
                 show[k] = v
         else:
+            removed = 0
+            if cascade:
+                for dep in reversed(rec.data_store.dependents(rec)):
+                    dep.remove()
+                    removed += 1
             rec.remove()
             show['action'] = 'deleted'
+            if cascade:
+                show['cascaded'] = removed
+            self.persist('/delete/' + record, data)
         return show
 
-    def list_records(self, record, data):
-        """Show html table of records"""
-        return export.serve(
-            self.general, record, json.loads(data) if data else {})
+    def list_records(self, record, data, send, snap):
+        """Html table with a page of records, the after, limit and stream
+           parameters are in the url or the data"""
+        table, _, query = record.partition('?')
+        params = json.loads(data) if data else {}
+        params.update(parse_qsl(query))
+        return export.serve(snap, self.records[table], params, send)
 
     def _add_record(self, record, data):
         """Add a record to the data set"""
@@ -207,9 +303,101 @@ class Server(object):
         show['action'] = 'added'
         return show
 
+    def record_bulk(self, table, data):
+        """Add many records from a JSON array or from one row per line and
+           report the rows that are not added. A large upload is sent as
+           several messages of rows, the rows of a message are numbered
+           from its 'first' parameter and committed together."""
+        table, _, query = table.partition('?')
+        first = int(dict(parse_qsl(query)).get('first', 0))
+        show = OrderedDict()
+        errors = []
+        if data.lstrip().startswith('['):
+            rows = list(enumerate(json.loads(data), first))
+        else:
+            rows = []
+            for nr, line in enumerate(io.StringIO(data), first):
+                if not line.strip():
+                    continue
+                try:
+                    rows.append((nr, json.loads(line)))
+                except ValueError:
+                    errors.append(_row_error(nr, 'Incorrect JSON'))
+        added = self._add_rows(table, rows, errors)
+        if errors and not added:
+            show['action'] = 'error'
+            show['message'] = 'Errors in rows'
+        else:
+            show['action'] = 'added'
+        show['added'] = added
+        show['errors'] = sorted(errors, key=lambda e: e['row'])
+        return show
+
+    def _bulk_table(self, name):
+        """Class and parent of the records of a bulk table, the records of
+           a Set of a stored record are named <table>/<key>/<set>"""
+        table, _, rest = name.partition('/')
+        clazz = self.records.get(table)
+        if clazz is None or clazz is self.general.__class__:
+            return None, None
+        if not rest:
+            return clazz, self.general
+        key, _, name = rest.rpartition('/')
+        parent = self._find(table, key) if key else None
+        fld = getattr(clazz, 'field_on_name').get(name)
+        if parent is None or not isinstance(fld, Set):
+            return None, None
+        return fld.related, parent
+
+    def _add_rows(self, table, rows, errors):
+        """Validate the rows in one pass, add the valid ones in key order
+           and persist them at once, return their number"""
+        store = self.general.stored
+        order = dict((name, pos) for pos, name in enumerate(self.records))
+        valid = []
+        keys = set()
+        for nr, row in rows:
+            if table:
+                name, fields = table, row
+            elif isinstance(row, dict):
+                name, fields = str(row.get('table', '')), row.get('data')
+            else:
+                name, fields = '', None
+            clazz, parent = self._bulk_table(name)
+            if clazz is None:
+                errors.append(_row_error(nr, 'Unknown table "' + name + '"'))
+                continue
+            if not isinstance(fields, dict):
+                errors.append(_row_error(nr, 'Expect an object with fields'))
+                continue
+            res = clazz.validate(clazz, fields, add=True)
+            if not res:
+                rec = clazz(parent)
+                rec.read(fields)
+                key = rec.get_key()
+                if parent is self.general:
+                    stored = key in store.keyed.get(clazz, {})
+                else:
+                    stored = key in getattr(parent, name.rpartition('/')[2])
+                if (clazz, id(parent), key) in keys or stored:
+                    res = dict((fld, 'Duplicate key') for fld in clazz.keys)
+            if res:
+                errors.append(_row_error(nr, 'Errors in fields', res))
+                continue
+            keys.add((clazz, id(parent), key))
+            valid.append((order[name.partition('/')[0]], parent.get_key(),
+                          key, nr, rec, name, fields))
+        valid.sort(key=lambda v: v[:4])
+        for _, _, _, _, rec, _, _ in valid:
+            rec.store()
+        if valid:
+            self.persist('/bulk/', json.dumps(
+                [{'table': v[5], 'data': v[6]} for v in valid]))
+        return len(valid)
+
     def record_write(self, record, data):
         """Change the content of a record"""
-        show = OrderedDict()
+        change = data
         if data:
             data = json.loads(data)
         pos = record.find("/")
@@ -218,80 +406,180 @@ class Server(object):
             pos = -1
         is_root = pos <= 0 and self.records[record] == self.general.__class__
         if pos <= 0 and not is_root:  # new record
-            res = self._add_record(record, data)
-            if res:
-                return res
+            show = self._add_record(record, data)
         else:
             if is_root:
                 clazz = self.general.__class__
-                recset = None
-                key = None
+                rec = self.general
             else:
                 table = record[:pos]
-                recset = getattr(self.general, self.records[table].path)
-                key = record[pos + 1:]
-                if key not in recset:
+                rec = self._find(table, record[pos + 1:])
+                if rec is None:
                     return {
                         'action': 'error',
-                        'message': 'Unknown ' + table + ' "' + key + '"'}
+                        'message': 'Unknown ' + table + ' "' +
+                                   record[pos + 1:] + '"'}
                 clazz = self.records[table]
-            rec = recset[key] if not is_root else self.general
-            res = _change_record(clazz, rec, data, recset, key)
-            if res:
-                return res
-        if self.file:
+            show = _change_record(clazz, rec, data)
+        if show['action'] != 'error':
+            self.persist('/write/' + record, change)
+        return show
+
+    def persist(self, url, data):
+        """Make an accepted change durable, or leave it to the group commit
+           when handling websocket messages. In a transaction the change is
+           journaled when it commits."""
+        trans = self.general.stored.trans
+        if trans is not None:
+            trans.on_commit(lambda: self._journal(url, data))
+            return
+        self._journal(url, data)
+        if not self.group.grouping:
+            self.commit()
+
+    def _journal(self, url, data):
+        """Journal an accepted change that waits for the next commit"""
+        if self.journal:
+            self.journal.write(url, data, sync=False)
+        self.group.pending += 1
+
+    def apply(self, func, *args):
+        """Call func with a change in a transaction on the store: it is
+           rolled back when func fails or answers with an error, and made
+           durable once the outermost transaction commits"""
+        store = self.general.stored
+        outer = store.trans is None
+        with store.transaction() as trans:
+            show = func(*args)
+            if show.get('action') == 'error':
+                trans.rollback()
+        group = self.group
+        if outer and group.pending and not group.grouping:
+            self.commit()
+        return show
+
+    def commit(self):
+        """Make all accepted changes durable at once, return their number"""
+        count = self.group.pending
+        self.group.pending = 0
+        if count and self.journal:
+            self.journal.sync()
+        elif count and self.file:
             self.general.output(self.file)
+        return count
+
+    def show_metrics(self):
+        """Sizes and latencies of the group commits"""
+        show = self.group.stats()
+        show['cache'] = self.cache.stats()
         return show
 
-    def record_form(self, record):
-        """Create a HTML form for this record"""
+    def cached(self, url, table, make, snap=None):
+        """Response from the cache while the table and the tables it
+           relates to are unchanged, a response from a given snapshot can
+           be older than the tables and is not cached"""
+        if snap is not None:
+            return make()
+        clazz = self.records[table]
+        store = getattr(clazz, 'data_store')
+        versions = (store.version(clazz),) + tuple(
+            store.version(fld.related) for fld in clazz.fields
+            if isinstance(fld, Relation))
+        return self.cache.get(url, versions, make)
+
+    def replay(self):
+        """Apply the changes in the journal on top of the loaded data"""
+        journal = self.journal
+        self.journal = None
+        file = self.file
+        self.file = None
+        try:
+            for url, data in journal.read():
+                self.call(url, data)
+        finally:
+            self.journal = journal
+            self.file = file
+        return journal.entries
+
+    def record_form(self, out, record, snap):
+        """Write a HTML form for this record as it was when pinned"""
         pos = record.find("/")
         add = False
         if pos <= 0 or pos == len(record) - 1:
             if pos > 0:
                 record = record[:pos]
             if record not in self.records:
-                return '<h1>Unknown record "' + record + '"</h1>'
+                out.write('<h1>Unknown record "', record, '"</h1>')
+                return
             rec = self.records[record](self.general)
             add = True
         else:
             table = record[:pos]
             key = record[pos + 1:]
             if table not in self.records:
-                return '<h1>Unknown record "' + table + '"</h1>'
-            records = getattr(self.general, self.records[table].path)
-            if key not in records:
-                return '<h1>Unknown ' + table + ' "' + key + '"</h1>'
-            rec = records[key]
-        return form.form(rec, ("Add " if add else "Edit ") + rec.get_name())
-
-    def field_info(self, table):
+                out.write('<h1>Unknown record "', table, '"</h1>')
+                return
+            rec = self._find(table, key, snap)
+            if rec is None:
+                out.write('<h1>Unknown ', table, ' "', key, '"</h1>')
+                return
+            rec = snap.view(rec)
+        form.form(
+            out, rec, ("Add " if add else "Edit ") + rec.get_name(), snap)
+
+    def field_info(self, table, snap):
         """Show the known information about the fields of this record"""
         fields = []
         for fld in self.records[table].fields:
             if isinstance(fld, Set):
                 continue
-            info = field_values(fld, self.general)
+            info = field_values(fld, snap)
             fields.append(info)
         return fields
 
-    def call(self, url, data):
-        """Match the url and call the different corresponding routines"""
+    def _pinned(self, func, *args, snap=None):
+        """Render with func from a snapshot given as its last argument, a
+           snapshot is pinned for the render when none is given"""
+        if snap is not None:
+            return func(*args, snap)
+        with self.general.stored.snapshot() as current:
+            return func(*args, current)
+
+    def call(self, url, data, stream=False, send=None, snap=None):
+        """Match the url and call the different corresponding routines, with
+           stream a HTML page is returned as its writer to send it in
+           chunks, lines of a streamed list are passed to send. Pages and
+           records are rendered from the snapshot or one pinned for it."""
         try:
             if url in ['/fields/', '/fields', '/record', '/record/']:
                 res = layout(self.show_table())
             elif url.startswith("/fields/"):
-                res = layout(self.field_info(url[8:]))
+                res = self.cached(url, url[8:], lambda: layout(
+                    self._pinned(self.field_info, url[8:], snap=snap)), snap)
             elif url.startswith('/record/'):
-                res = layout(self.record_info(url[8:]))
+                res = self.cached(url, url[8:].split('/')[0], lambda: layout(
+                    self._pinned(self.record_info, url[8:], snap=snap)), snap)
+            elif url.startswith('/metrics'):
+                res = layout(self.show_metrics())
+            elif url.startswith('/query/'):
+                res = layout(self.record_query(url[7:], data))
             elif url.startswith('/delete/'):
-                res = layout(self.record_delete(url[8:]))
+                res = layout(self.apply(self.record_delete, url[8:], data))
+            elif url.startswith('/bulk/'):
+                res = layout(self.apply(
+                    self.record_bulk, url[6:].strip('/'), data))
             elif url.startswith('/write/'):
-                res = layout(self.record_write(url[7:], data))
+                res = layout(self.apply(self.record_write, url[7:], data))
             elif url.startswith('/form/'):
-                res = self.record_form(url[6:])
+                res = Writer()
+                self._pinned(self.record_form, res, url[6:], snap=snap)
+                if not stream:
+                    res = res.getvalue()
             elif url.startswith('/list/'):
-                res = self.list_records(url[6:], data)
+                res = self._pinned(
+                    self.list_records, url[6:], data, send, snap=snap)
+                if not stream:
+                    res = res.getvalue()
             else:
                 res = layout(show_documentation())
             return res
@@ -306,19 +594,103 @@ class Server(object):
                 'message': e.args[0]}
             return layout(show)
 
-    def handler(self, ws, path):
-        """Handle requests from the websocket server"""
-        if path == "/":
-            lines = yield from ws.recv().split("/n")
-            result = self.call(lines[0], lines[1] if len(lines) > 1 else "")
-            yield from ws.send(result)
-        else:
-            yield from ws.send("Unknown url: " + path)
+    async def respond(self, ws, message):
+        """Answer a message, tagged with its request id when it has one,
+           changes are acknowledged after they are committed"""
+        req_id, url, data = split_message(message)
+        if url.startswith('/list/'):
+            await self.respond_list(ws, req_id, url, data)
+            return
+        result, wrote = await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.group.call, self.call, url, data, True)
+        if wrote:
+            try:
+                await self.group.wait()
+            except Exception as e:  # pylint: disable=broad-except
+                result = layout({
+                    'action': 'error',
+                    'message': 'Change not saved: ' + str(e)})
+        if isinstance(result, Writer):  # send pages chunk by chunk
+            result = list(result.chunks(CHUNK_SIZE))
+            if req_id is not None:
+                result[0] = req_id + "\n" + result[0]
+            if len(result) == 1:
+                result = result[0]
+        elif req_id is not None:
+            result = req_id + "\n" + result
+        try:
+            if not isinstance(result, str):
+                await ws.send(result)
+            elif len(result) > CHUNK_SIZE:  # send large results in frames
+                await ws.send(chunks(result))
+            else:
+                await ws.send(result)
+        except ConnectionClosed:
+            pass  # the client left, a change is made nevertheless
+
+    async def respond_list(self, ws, req_id, url, data):
+        """Answer a list, a streamed list is sent in fragments while its
+           lines are written. The list is rendered from a snapshot pinned
+           between the requests, so the writes after it go on meanwhile."""
+        loop = asyncio.get_event_loop()
+        lines = asyncio.Queue()
+        snap = await loop.run_in_executor(
+            self.executor, self.general.stored.snapshot)
+
+        def send(text):
+            """Pass a written part of the page to the event loop"""
+            loop.call_soon_threadsafe(lines.put_nowait, text)
+
+        done = loop.run_in_executor(
+            self.readers, self.call, url, data, True, send, snap)
+        done.add_done_callback(lambda _: snap.release())
+        done.add_done_callback(lambda _: lines.put_nowait(None))
+
+        async def fragments():
+            """The request id, the streamed lines and the rest of the page"""
+            if req_id is not None:
+                yield req_id + "\n"
+            while True:
+                text = await lines.get()
+                if text is None:
+                    break
+                yield text
+            result = done.result()
+            for text in (result.chunks(CHUNK_SIZE) if
+                         isinstance(result, Writer) else chunks(result)):
+                if text:
+                    yield text
+
+        try:
+            await ws.send(fragments())
+        except ConnectionClosed:
+            pass
+
+    async def handler(self, ws, path):
+        """Handle the messages of a websocket connection until it closes,
+           messages with a request id are answered as soon as they are done
+           while the next messages are read"""
+        if path != "/":
+            await ws.send("Unknown url: " + path)
+            return
+        pending = set()
+        async for message in ws:
+            if isinstance(message, bytes):
+                message = message.decode()
+            if message.startswith('/'):  # no id, answer in order
+                await self.respond(ws, message)
+                continue
+            task = asyncio.ensure_future(self.respond(ws, message))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
 
     def start(self):
         """Start the websocket server"""
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
-        server = serve(self.handler, 'localhost', 8080)
+        server = serve(
+            self.handler, 'localhost', 8080, max_size=MAX_MESSAGE)
         self.server = self.loop.run_until_complete(server)
         self.loop.run_forever()
@@ -0,0 +1,194 @@
+"""Binary snapshot of a data file for a fast startup"""
+import os
+import struct
+from datetime import datetime
+
+from fields import Number, Amount, Enum, Date, Boolean, Relation, Set
+from journal import checksum
+
+MAGIC = b'AESNAP1\n'
+
+
+def snapshot_name(file):
+    """Name of the snapshot next to a data file"""
+    return os.path.splitext(file)[0] + '.snap'
+
+
+def _write_int(out, val):
+    """Append a zigzag encoded variable length integer"""
+    val = val * 2 if val >= 0 else -val * 2 - 1
+    while val >= 0x80:
+        out.append(val & 0x7f | 0x80)
+        val >>= 7
+    out.append(val)
+
+
+def _write_bytes(out, val):
+    """Append a length prefixed byte string"""
+    _write_int(out, len(val))
+    out += val
+
+
+class Writer(object):
+    """Encode records: every field starts with a tag, 0 for an empty value.
+       Enums are written as their index and relations as the number of the
+       related record within its class in writing order."""
+    def __init__(self):
+        self.numbers = {}  # id of a record to its number within its class
+        self.counts = {}
+
+    def _number(self, rec):
+        """Give all records a number in the order they will be written"""
+        for fld in rec.fields:
+            if isinstance(fld, Set) and fld.primary:
+                for sub in getattr(rec, fld.name):
+                    self._number(sub)
+                    count = self.counts.get(fld.related, 0)
+                    self.numbers[id(sub)] = count
+                    self.counts[fld.related] = count + 1
+
+    def _field(self, out, fld, val):
+        """Append the encoded value of a field"""
+        out.append(1)
+        if isinstance(fld, Relation):
+            if id(val) not in self.numbers:
+                raise ValueError(
+                    "Relation " + fld.name + " to a record that is not stored")
+            _write_int(out, self.numbers[id(val)])
+        elif isinstance(fld, (Enum, Number, Amount)):
+            _write_int(out, val)
+        elif isinstance(fld, Boolean):
+            out.append(1 if val else 0)
+        elif isinstance(fld, Date):
+            _write_int(out, val.toordinal())
+        else:
+            _write_bytes(out, fld.write(val).encode())
+
+    def record(self, out, rec):
+        """Append a length prefixed record with its sub records"""
+        body = bytearray()
+        for fld in rec.fields:
+            if isinstance(fld, Set):
+                if not fld.primary:
+                    continue
+                recs = getattr(rec, fld.name)
+                _write_int(body, len(recs))
+                for sub in recs:
+                    self.record(body, sub)
+                continue
+            val = getattr(rec, fld.name, None)
+            if val:
+                self._field(body, fld, val)
+            else:
+                body.append(0)
+        _write_bytes(out, body)
+
+    def write(self, general):
+        """Return the encoded data store"""
+        self._number(general)
+        out = bytearray()
+        self.record(out, general)
+        return out
+
+
+class Reader(object):
+    """Decode records and resolve the relations afterwards"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.numbered = {}  # class to its records in writing order
+        self.relations = []
+        self.order = []  # records and their Set, sub records first
+
+    def _int(self):
+        """Read a zigzag encoded variable length integer"""
+        data = self.data
+        res = 0
+        shift = 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            res |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        return res >> 1 if res & 1 == 0 else -(res >> 1) - 1
+
+    def _bytes(self):
+        """Read a length prefixed byte string"""
+        length = self._int()
+        self.pos += length
+        return self.data[self.pos - length:self.pos]
+
+    def _field(self, rec, fld):
+        """Read the value of a field"""
+        if isinstance(fld, Relation):
+            self.relations.append((rec, fld, self._int()))
+            return
+        if isinstance(fld, (Enum, Number, Amount)):
+            val = self._int()
+        elif isinstance(fld, Boolean):
+            val = self.data[self.pos] == 1
+            self.pos += 1
+        elif isinstance(fld, Date):
+            val = datetime.fromordinal(self._int())
+        else:
+            val = fld.read(str(self._bytes(), 'utf-8'))
+        setattr(rec, fld.name, val)
+
+    def record(self, rec):
+        """Read a record with its sub records"""
+        self._int()  # length of the record
+        for fld in rec.fields:
+            if isinstance(fld, Set):
+                if not fld.primary:
+                    continue
+                for _ in range(self._int()):
+                    sub = fld.related(rec)
+                    self.record(sub)
+                    self.numbered.setdefault(fld.related, []).append(sub)
+                    self.order.append((sub, fld))
+                continue
+            tag = self.data[self.pos]
+            self.pos += 1
+            if tag:
+                self._field(rec, fld)
+
+    def read(self, general):
+        """Read all records into general and store them, sub records are
+           only put in their Set and indexed once with their top record"""
+        self.record(general)
+        for rec, fld, number in self.relations:
+            setattr(rec, fld.name, self.numbered[fld.related][number])
+        for rec, fld in self.order:
+            if rec.parent is general:
+                rec.store()
+            else:
+                getattr(rec.parent, fld.name)[rec.get_key()] = rec
+
+
+def write_snapshot(file, general):
+    """Write the snapshot for the current content of a data file"""
+    name = snapshot_name(file)
+    data = Writer().write(general)
+    with open(name + '.new', 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<I', checksum(file)))
+        fp.write(data)
+    os.replace(name + '.new', name)
+
+
+def load_snapshot(file, general):
+    """Load the snapshot when it matches the data file, return if it did"""
+    name = snapshot_name(file)
+    if not os.path.exists(name):
+        return False
+    with open(name, 'rb') as fp:
+        data = fp.read()
+    head = len(MAGIC) + 4
+    if data[:len(MAGIC)] != MAGIC or len(data) < head or \
+            struct.unpack('<I', data[len(MAGIC):head])[0] != checksum(file):
+        return False
+    reader = Reader(memoryview(data)[head:])
+    reader.read(general)
+    return True
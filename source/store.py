@@ -0,0 +1,426 @@
+"""The data store with its indexes, snapshots and transactions"""
+import copy
+
+from fields import Relation, Set, _index_value, _record_path
+from options import OptionList
+from rbtree import RBDict, Versions
+
+
+class Store(object):
+    """Central object holding a data store"""
+    def __init__(self):
+        self.root = None
+        self._changes = False
+        self.indexes = {}
+        self.referenced = {}  # id of a record to {(id, field): record}
+        self.referencing = {}  # id of a stored record with relation fields
+        self.keyed = {}  # top level class to {key values: record}
+        self.columns = []  # columnar copies of sub records
+        self.kept = {}  # id of a record to the record and its old copies
+        self.versions = {}  # class to its number of changes
+        self.options = {}  # class to the option list of its records
+        self.undo = None  # record, field, old value of each change in a row
+        self.trans = None  # the outermost open transaction
+        self.generations = Versions()  # pinned by the snapshots
+
+    def changes(self, remember_changes=True):
+        """Start or stop remembering changes on records"""
+        self._changes = remember_changes
+        self.undo = [] if remember_changes else None
+        for fld in self.root.fields:
+            if not isinstance(fld, Set) or not fld.primary:
+                continue
+            getattr(self.root, fld.name).remember_changes(self._changes)
+
+    def init(self, root):
+        """Set the root product of the store"""
+        self.root = root
+        for fld in root.fields:
+            if isinstance(fld, Set):
+                getattr(root, fld.name).versions = self.generations
+
+    def register(self, *classes):
+        """Register a set of classes to the store"""
+        names = {}
+        for fld in self.root.fields:
+            names[fld.name] = fld
+        setattr(self.root.__class__, 'field_on_name', names)
+        setattr(self.root.__class__, 'data_store', self)
+        for clazz in classes:
+            names = {}
+            for fld in clazz.fields:
+                names[fld.name] = fld
+            setattr(clazz, 'field_on_name', names)
+            setattr(clazz, 'data_store', self)
+            for idx in getattr(clazz, 'indexes', []):
+                for key in idx.keys:
+                    if key not in names:
+                        raise KeyError(
+                            key + " not found in " + clazz.__name__)
+                self.indexes[(clazz, idx.name)] = RBDict()
+
+    def _index_key(self, rec, idx):
+        """Tuple with the indexed values followed by the record path"""
+        names = getattr(rec, 'field_on_name')
+        key = tuple(_index_value(names[fld], getattr(rec, fld, None))
+                    for fld in idx.keys)
+        return key + _record_path(rec)
+
+    def add_indexes(self, rec):
+        """Add a stored record and its sub records to the secondary
+           indexes and the referenced-by index"""
+        if self.trans is not None:
+            self.trans.log += rec, None, True
+        self._add_indexes(rec)
+
+    def _add_indexes(self, rec):
+        """Add a record and its sub records to the indexes"""
+        self.touch(rec)
+        for idx in getattr(rec, 'indexes', []):
+            self.indexes[(rec.__class__, idx.name)][
+                self._index_key(rec, idx)] = rec
+        if getattr(rec, 'path', None):
+            self.keyed.setdefault(rec.__class__, {})[rec.get_key()] = rec
+        rels = [fld for fld in rec.fields if isinstance(fld, Relation)]
+        if rels:
+            self.referencing[id(rec)] = rec
+        for fld in rels:
+            target = getattr(rec, fld.name, None)
+            if target is not None:
+                self.referenced.setdefault(id(target), {})[
+                    (id(rec), fld.name)] = rec
+        for col in self.columns:
+            if isinstance(rec, col.clazz):
+                col.add(rec)
+        if rec.__class__ in self.options:
+            self.options[rec.__class__].add(rec)
+        for fld in rec.fields:
+            if isinstance(fld, Set) and fld.primary:
+                for sub in getattr(rec, fld.name):
+                    self._add_indexes(sub)
+
+    def remove_indexes(self, rec):
+        """Remove a record and its sub records from the secondary indexes
+           and the referenced-by index, return True when it was indexed"""
+        if self.trans is not None:
+            self.trans.log += rec, None, False
+        return self._remove_indexes(rec)
+
+    def _remove_indexes(self, rec):
+        """Remove a record and its sub records from the indexes"""
+        self.touch(rec)
+        found = False
+        for idx in getattr(rec, 'indexes', []):
+            index = self.indexes[(rec.__class__, idx.name)]
+            key = self._index_key(rec, idx)
+            if key in index:
+                del index[key]
+                found = True
+        keyed = self.keyed.get(rec.__class__, {})
+        if getattr(rec, 'path', None) and \
+                keyed.get(rec.get_key()) is rec:
+            del keyed[rec.get_key()]
+        if id(rec) in self.referencing:
+            del self.referencing[id(rec)]
+            found = True
+            for fld in rec.fields:
+                target = getattr(rec, fld.name, None)
+                if not isinstance(fld, Relation) or target is None:
+                    continue
+                used = self.referenced.get(id(target))
+                if used is not None:
+                    used.pop((id(rec), fld.name), None)
+                    if not used:
+                        del self.referenced[id(target)]
+        for col in self.columns:
+            if isinstance(rec, col.clazz):
+                col.remove(rec)
+        if rec.__class__ in self.options:
+            self.options[rec.__class__].remove(rec)
+        for fld in rec.fields:
+            if isinstance(fld, Set) and fld.primary:
+                for sub in getattr(rec, fld.name):
+                    self._remove_indexes(sub)
+        return found
+
+    def relate(self, rec, name, target):
+        """Write a relation field and keep the indexes of a stored
+           record up to date, only the indexes on this field change"""
+        if id(rec) not in self.referencing:  # not stored yet
+            setattr(rec, name, target)
+            if name in getattr(rec, 'keys'):
+                setattr(rec, 'cached_key', None)
+            return
+        if self.trans is not None:
+            self.trans.log += rec, name, getattr(rec, name, None)
+        self.keep(rec)
+        self.touch(rec)
+        indexes = [idx for idx in getattr(rec, 'indexes', [])
+                   if name in idx.keys]
+        for idx in indexes:
+            index = self.indexes[(rec.__class__, idx.name)]
+            key = self._index_key(rec, idx)
+            if key in index:
+                del index[key]
+        columns = [col for col in self.columns
+                   if isinstance(rec, col.clazz) and col.relation == name]
+        for col in columns:
+            col.remove(rec)
+        keyed = None
+        options = None
+        if name in getattr(rec, 'keys') and getattr(rec, 'path', None):
+            keyed = self.keyed.get(rec.__class__, {})
+            keyed.pop(rec.get_key(), None)
+            options = self.options.get(rec.__class__)
+            if options is not None:
+                options.remove(rec)
+        old = getattr(rec, name, None)
+        if old is not None:
+            used = self.referenced.get(id(old))
+            if used is not None:
+                used.pop((id(rec), name), None)
+                if not used:
+                    del self.referenced[id(old)]
+        setattr(rec, name, target)
+        if name in getattr(rec, 'keys'):
+            setattr(rec, 'cached_key', None)
+        if target is not None:
+            self.referenced.setdefault(id(target), {})[(id(rec), name)] = rec
+        if keyed is not None:
+            keyed[rec.get_key()] = rec
+        if options is not None:
+            options.add(rec)
+        for idx in indexes:
+            self.indexes[(rec.__class__, idx.name)][
+                self._index_key(rec, idx)] = rec
+        for col in columns:
+            col.add(rec)
+
+    def option_list(self, clazz):
+        """Options to choose a record of a class from, kept up to date
+           from the first time they are asked for"""
+        options = self.options.get(clazz)
+        if options is None:
+            options = OptionList(getattr(self.root, clazz.path))
+            self.options[clazz] = options
+        return options
+
+    def touch(self, rec):
+        """Count a change of a record in the version of its table"""
+        clazz = rec.__class__
+        self.versions[clazz] = self.versions.get(clazz, 0) + 1
+
+    def version(self, clazz):
+        """Number of changes to the records of a class"""
+        return self.versions.get(clazz, 0)
+
+    def snapshot(self):
+        """Pin the current state for reading while changes continue"""
+        return Snapshot(self)
+
+    def transaction(self):
+        """Group changes that are kept or rolled back together"""
+        return Transaction(self)
+
+    def keep(self, rec):
+        """Before a stored record changes: keep a copy of it for the pinned
+           snapshots that still see its old values"""
+        pinned = self.generations.pinned()
+        if not pinned:
+            if self.kept:
+                self.kept = {}
+            return
+        current = self.generations.current
+        old = self.kept.get(id(rec))
+        history = [] if old is None or old[0] is not rec else [
+            kept for kept in old[1] if kept[0] >= min(pinned)]
+        if history and history[-1][0] == current - 1:
+            return  # already kept in this generation
+        if max(pinned) > (history[-1][0] if history else -1):
+            history.append((current - 1, copy.copy(rec)))
+        self.kept[id(rec)] = rec, history
+
+    def referenced_by(self, rec):
+        """List the stored records with a relation to this record"""
+        return list(self.referenced.get(id(rec), {}).values())
+
+    def dependents(self, rec):
+        """All records that directly or indirectly relate to this record,
+           the records to remove first are at the end of the list"""
+        res = []
+        seen = {id(rec)}
+        todo = [rec]
+        while todo:
+            for dep in self.referenced_by(todo.pop()):
+                if id(dep) not in seen:
+                    seen.add(id(dep))
+                    res.append(dep)
+                    todo.append(dep)
+        return res
+
+    def lookup(self, clazz, name, *values):
+        """Iterate the records of a class with the given leading values
+           of a secondary index"""
+        if (clazz, name) not in self.indexes:
+            raise KeyError(name + " index not found in " + clazz.__name__)
+        idx = [i for i in clazz.indexes if i.name == name][0]
+        names = getattr(clazz, 'field_on_name')
+        prefix = tuple(_index_value(names[fld], val)
+                       for fld, val in zip(idx.keys, values))
+        for _, rec in self.indexes[(clazz, name)].prefix(prefix):
+            yield rec
+
+
+class Snapshot(object):
+    """Consistent state of a data store to read while changes continue.
+       Pin it between changes, read it from any thread and release it."""
+    def __init__(self, store):
+        self.store = store
+        self.gen = store.generations.pin()
+
+    def record(self, rec):
+        """Copy of a record with its values when pinned"""
+        res = copy.copy(rec)  # before looking for a kept copy, see keep
+        old = self.store.kept.get(id(rec))
+        if old is not None and old[0] is rec:
+            for last, kept in old[1]:
+                if last >= self.gen:
+                    return kept
+        return res
+
+    def set(self, rec, name):
+        """Read-only view of a Set of a record as it was when pinned"""
+        return getattr(self.record(rec), name).at(self.gen)
+
+    def records(self, rec, name):
+        """The records in a Set of a record as they were when pinned"""
+        for sub in self.set(rec, name):
+            yield self.record(sub)
+
+    def table(self, clazz):
+        """Read-only view of the top level Set of a class when pinned"""
+        return self.set(self.store.root, clazz.path)
+
+    def view(self, rec):
+        """Copy of a record when pinned to render, its relations lead to
+           copies of the related records when pinned"""
+        res = copy.copy(self.record(rec))  # kept copies are shared
+        for fld in rec.fields:
+            val = getattr(res, fld.name)
+            if isinstance(fld, Relation) and val is not None:
+                setattr(res, fld.name, self.record(val))
+        return res
+
+    def options(self, clazz):
+        """Option list of a class when pinned, the current list while the
+           records of the class did not change"""
+        if self.table(clazz).root is getattr(self.store.root, clazz.path).root:
+            return self.store.option_list(clazz)
+        return OptionList(self.record(rec) for rec in self.table(clazz))
+
+    def release(self):
+        """Let changes stop keeping the pinned state"""
+        if self.gen is not None:
+            self.store.generations.release(self.gen)
+            self.gen = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Transaction(object):
+    """Changes to a data store that are kept or rolled back together. The
+       log holds record, field, old value of each change in a row, with
+       field None and True for a stored or False for a removed record. A
+       transaction inside another one rolls back to its own start."""
+    def __init__(self, store):
+        self.store = store
+        self.outer = store.trans
+        if self.outer is None:
+            self.log = []
+            self.commits = []
+            store.trans = self
+        else:
+            self.log = self.outer.log
+            self.commits = self.outer.commits
+        self.start = len(self.log)
+        self.calls = len(self.commits)
+        self.undo = len(store.undo) if store.undo is not None else 0
+        self.done = False
+
+    def on_commit(self, func):
+        """Call func when the outermost transaction commits"""
+        self.commits.append(func)
+
+    def commit(self):
+        """Keep the changes, the outermost transaction validates them
+           together and calls the functions given to on_commit. Changes that
+           are not valid together are rolled back."""
+        if self.done:
+            raise ValueError("Transaction already finished")
+        if self.outer is None:
+            problem = self.validate()
+            if problem is not None:
+                self.rollback()
+                raise ValueError(problem)
+        self.done = True
+        if self.outer is None:
+            self.store.trans = None
+            for func in self.commits:
+                func()
+
+    def validate(self):
+        """Problem with the changes together: a record that is removed while
+           a stored record still relates to it, None when valid"""
+        log = self.log
+        stored = {}
+        for pos in range(self.start, len(log), 3):
+            if log[pos + 1] is None:
+                stored[id(log[pos])] = log[pos], log[pos + 2]
+        for rec, kept in stored.values():
+            if not kept and self.store.referenced_by(rec):
+                return "Removed " + rec.get_name() + " " + rec.get_id() + \
+                    " is still used by other records"
+        return None
+
+    def rollback(self):
+        """Undo the changes since the start of this transaction"""
+        if self.done:
+            raise ValueError("Transaction already finished")
+        self.done = True
+        store = self.store
+        log = self.log
+        store.trans = None  # undoing is no change to log
+        try:
+            for pos in range(len(log) - 3, self.start - 1, -3):
+                rec, name, value = log[pos], log[pos + 1], log[pos + 2]
+                if name is None:
+                    if value:
+                        rec.remove()
+                    else:
+                        rec.store()
+                elif isinstance(rec.field(name), Relation):
+                    store.relate(rec, name, value)
+                else:
+                    setattr(rec, name, value)
+                    setattr(rec, 'cached_key', None)
+        finally:
+            del log[self.start:]
+            del self.commits[self.calls:]
+            if store.undo is not None:
+                del store.undo[self.undo:]
+            store.trans = self.outer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.done:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
@@ -1,13 +1,19 @@
 """Tables inside the database"""
-import copy
-
-from fields import String, Number, Enum, Relation, Set, Record
+from fields import String, Number, Enum, Relation, Set, Record, Index
+from store import Store
 from rbtree import RBDict
 
 
 # pylint: disable=no-self-use
 class Statistic(Record):
     """Statistics for persons, aliens and items"""
+    __slots__ = 'type', 'name', 'description', \
+        'first_train', 'second_train'  # added by tables_init
+    type: int
+    name: str
+    description: str
+    first_train: 'Statistic'
+    second_train: 'Statistic'
     path = 'statistics'
     fields = [
         Enum('type', ['training', 'skill', 'statistic']),
@@ -15,40 +21,31 @@ class Statistic(Record):
         String('description')
     ]
     keys = ['type', 'name']
-
-    def __init__(self, parent):
-        self.parent = parent
-        self.type = None
-        self.name = None
-        self.first_train = None
-        self.second_train = None
-        self.description = None
+    indexes = [
+        Index('first_train', ['first_train']),
+        Index('second_train', ['second_train'])
+    ]
 
     def store(self):
         """Store the Automatic"""
-        self.parent.statistics[self.get_id()] = self
+        self.parent.statistics[self.get_key()] = self
+        getattr(self, 'data_store').add_indexes(self)
 
     def remove(self):
         """Remove the Automatic from the index"""
-        del self.parent.statistics[self.get_id()]
-
-    def find(self, data):
-        """Find the record with the relation key"""
-        root = getattr(self, 'data_store').root
-        fld = getattr(self, 'field_on_name')['type']
-        key = "{:07d}".format(fld.read(data['type'])) + \
-              "|" + data['name']
-        if key not in root.statistics:
-            return None
-        return root.statistics[key]
+        del self.parent.statistics[self.get_key()]
+        getattr(self, 'data_store').remove_indexes(self)
 
     def removable(self, general):
-        """This record cannot be removed savely"""
-        return {"statistic": None}
+        """This record can be removed when nothing relates to it"""
+        return self.referenced()
 
 
 class Action(Record):
     """Actions a person can do in the game"""
+    __slots__ = 'name', 'description'
+    name: str
+    description: str
     path = 'actions'
     fields = [
         String('name'),
@@ -56,56 +53,41 @@ class Action(Record):
     ]
     keys = ['name']
 
-    def __init__(self, parent):
-        self.parent = parent
-        self.name = None
-
     def store(self):
         """Store the Automatic"""
-        self.parent.actions[self.get_id()] = self
+        self.parent.actions[self.get_key()] = self
+        getattr(self, 'data_store').add_indexes(self)
 
     def remove(self):
         """Remove the Automatic from the index"""
-        del self.parent.actions[self.get_id()]
-
-    def find(self, data):
-        """Find the record with the relation key"""
-        if data['name'] not in self.root().actions:
-            return None
-        return self.root().actions[data['name']]
+        del self.parent.actions[self.get_key()]
+        getattr(self, 'data_store').remove_indexes(self)
 
     def removable(self, general):
-        """This record cannot be removed savely"""
-        return {"action": None}
+        """This record can be removed when nothing relates to it"""
+        return self.referenced()
 
 
 class Value(Record):
     """Value of a statistic on an item"""
+    __slots__ = 'statistic', 'value'
+    statistic: Statistic
+    value: int
     fields = [
         Relation('statistic', Statistic),
         Number('value')
     ]
     keys = ['statistic']
 
-    def __init__(self, parent):
-        self.parent = parent
-        self.statistic = None
-        self.value = 0
-
     def store(self):
         """Store the Automatic"""
-        self.parent.values[self.get_id()] = self
+        self.parent.values[self.get_key()] = self
+        getattr(self, 'data_store').add_indexes(self)
 
     def remove(self):
         """Remove the Automatic from the index"""
-        del self.parent.values[self.get_id()]
-
-    def find(self, data):
-        """Find the record with the relation key"""
-        if data['name'] not in self.root().statistics:
-            return None
-        item = self.root().items[data['type'] + "|" + data['name']]
-        return item.values[data['statistic']]
+        del self.parent.values[self.get_key()]
+        getattr(self, 'data_store').remove_indexes(self)
 
     def removable(self, general):
         """This record cannot be removed savely"""
@@ -114,6 +96,11 @@ class Value(Record):
 
 class Item(Record):
     """Items and some other things in the game"""
+    __slots__ = 'type', 'name', 'values'
+    type: int
+    name: str
+    values: RBDict
+    path = 'items'
     fields = [
         Enum('type', [
             'profession', 'armor', 'shield', 'weapon', 'gear', 'ammunition',
@@ -124,36 +111,31 @@ class Item(Record):
         Set('values', Value)
     ]
     keys = ['type', 'name']
-
-    def __init__(self, parent):
-        self.parent = parent
-        self.type = 0
-        self.name = None
-        self.values = RBDict()
+    indexes = [Index('type', ['type'])]
 
     def store(self):
         """Store the Automatic"""
-        self.parent.items[self.get_id()] = self
+        self.parent.items[self.get_key()] = self
+        getattr(self, 'data_store').add_indexes(self)
 
     def remove(self):
         """Remove the Automatic from the index"""
-        del self.parent.items[self.get_id()]
-
-    def find(self, data):
-        """Find the record with the relation key"""
-        key = "{:07d}".format(self.field('type').read(data['type'])) + \
-              "|" + data['name']
-        if key not in self.root().statistics:
-            return None
-        return self.root().items[key]
+        del self.parent.items[self.get_key()]
+        getattr(self, 'data_store').remove_indexes(self)
 
     def removable(self, general):
-        """This record cannot be removed savely"""
-        return {"statistic": None}
+        """This record can be removed when nothing relates to it"""
+        return self.referenced()
 
 
 class Game(Record):
     """General record with links to all other records"""
+    __slots__ = 'title', 'statistics', 'actions', 'items', 'stored'
+    title: str
+    statistics: RBDict
+    actions: RBDict
+    items: RBDict
+    stored: Store
     path = ''
     fields = [
         String('title'),
@@ -164,23 +146,17 @@ class Game(Record):
     keys = []
 
     def __init__(self, store):
+        super().__init__()
         self.stored = store
         self.title = ''
-        self.statistics = RBDict()
-        self.actions = RBDict()
-        self.items = RBDict()
 
     def store(self):
         """This this the top level element"""
         pass
 
     def remove(self):
-        """The top level element cannot be removed"""
-        if self.stored.remember_changes:
-            if getattr(self.stored, 'changed') is None:
-                setattr(self.stored, 'changed', copy.copy(self))
-        else:
-            setattr(self.stored, 'changed', copy.copy(self))
+        """The top level element cannot be removed, its changes are kept
+           in the undo log of the store"""
 
     def removable(self, general):
         """This record cannot be removed savely"""
@@ -190,8 +166,9 @@ class Game(Record):
 def tables_init(store):
     """Add some fields that are forward definitions"""
     game = Game(store)
-    Statistic.fields.append(Relation('first_train', Statistic))
-    Statistic.fields.append(Relation('second_train', Statistic))
+    if 'first_train' not in [fld.name for fld in Statistic.fields]:
+        Statistic.fields.append(Relation('first_train', Statistic))
+        Statistic.fields.append(Relation('second_train', Statistic))
     store.init(game)
     store.register(
         Statistic, Action, Item, Value)
@@ -0,0 +1,86 @@
+"""Tests on the columnar copy of item values"""
+import unittest
+
+from columns import Columns, numpy
+from read import reading
+from tables import Item, Value
+
+DATA = """title=Test, statistics=[
+  type=statistic, name=damage
+  type=statistic, name=armor
+], items=[
+  type=weapon, name=knife, values=[
+    statistic={type=statistic, name=damage}, value=2
+  ]
+  type=armor, name=vest, values=[
+    statistic={type=statistic, name=armor}, value=3
+  ]
+  type=weapon, name=rifle, values=[
+    statistic={type=statistic, name=damage}, value=6
+  ]
+  type=armor, name=helmet, values=[
+    statistic={type=statistic, name=armor}, value=2
+    statistic={type=statistic, name=damage}, value=1
+  ]
+]"""
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestColumns(unittest.TestCase):
+    """Vectorized reads on the values of items"""
+    def test_queries(self):
+        """Sort and aggregate the values of a statistic"""
+        game = reading(DATA)
+        cols = Columns(game.stored, Value, 'statistic', 'value', ['type'])
+        damage = game.statistics[(3, 'damage')]
+        armor = game.statistics[(3, 'armor')]
+        weapon = Item.field_on_name['type'].read('weapon')
+        self.assertEqual(
+            ['rifle', 'knife'],
+            [i.name for i in cols.sorted_rows(damage, True, type=weapon)])
+        self.assertEqual(
+            ['helmet', 'knife', 'rifle'],
+            [i.name for i in cols.sorted_rows(damage)])
+        self.assertEqual(
+            {Item.field_on_name['type'].read('armor'): 2.5},
+            cols.mean_by(armor, 'type'))
+
+    def test_changes(self):
+        """The columns follow changed and removed values"""
+        game = reading(DATA)
+        cols = Columns(game.stored, Value, 'statistic', 'value', ['type'])
+        damage = game.statistics[(3, 'damage')]
+        knife = game.items[(4, 'knife')]
+        knife.values[damage.get_key(), ].imp({'value': 9}, change=True)
+        rifle = game.items[(4, 'rifle')]
+        rifle.values[damage.get_key(), ].remove()
+        self.assertEqual(
+            ['knife', 'helmet'],
+            [i.name for i in cols.sorted_rows(damage, True)])
+        values, valid = cols.column(damage)
+        self.assertEqual(9, values[cols.ordinal[id(knife)]])
+        self.assertEqual(2, sum(valid))
+        self.assertNotIn(id(rifle), cols.ordinal)
+
+    def test_removed_rows(self):
+        """The row of a removed item is dropped and used again"""
+        game = reading(DATA)
+        cols = Columns(game.stored, Value, 'statistic', 'value', ['type'])
+        damage = game.statistics[(3, 'damage')]
+        rifle = game.items[(4, 'rifle')]
+        ordinal = cols.ordinal[id(rifle)]
+        rifle.remove()
+        self.assertNotIn(id(rifle), cols.ordinal)
+        self.assertNotIn(rifle, cols.rows)
+        self.assertEqual(
+            ['knife', 'helmet'],
+            [i.name for i in cols.sorted_rows(damage, True)])
+        gun = Item(game)
+        gun.imp({'type': 'weapon', 'name': 'gun'})
+        value = Value(gun)
+        value.imp({'statistic': damage.get_id(), 'value': 4})
+        self.assertEqual(ordinal, cols.ordinal[id(gun)])
+        self.assertEqual(4, len(cols.rows))
+        self.assertEqual(
+            ['gun', 'knife', 'helmet'],
+            [i.name for i in cols.sorted_rows(damage, True)])
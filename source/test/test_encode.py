@@ -0,0 +1,34 @@
+"""Tests on the layout of responses"""
+import unittest
+from collections import OrderedDict
+
+from encode import layout, chunks
+
+
+class TestLayout(unittest.TestCase):
+    """Compact JSON in a single pass"""
+    def test_layout(self):
+        """Dictionaries on one line, list items on their own lines"""
+        obj = [
+            OrderedDict([('b', [1, {'c': 'x, "y"'}]), ('a', 1), ('d', {})]),
+            ['s', 't'], None, True, 1.5]
+        self.assertEqual(
+            '[\n'
+            '  {"a":1, "b":[\n'
+            '      1,\n'
+            '      {"c":"x, \\"y\\""}\n'
+            '    ], "d":{}},\n'
+            '  [\n'
+            '    "s", "t"\n'
+            '  ],\n'
+            '  null,\n'
+            '  true,\n'
+            '  1.5\n'
+            ']', layout(obj))
+        self.assertEqual('[]', layout([]))
+
+    def test_chunks(self):
+        """Large responses are split in fragments"""
+        text = layout(['x' * 100] * 1000)
+        self.assertEqual(text, ''.join(chunks(text, 1000)))
+        self.assertEqual(1000, len(next(chunks(text, 1000))))
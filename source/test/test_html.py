@@ -0,0 +1,36 @@
+"""Tests on writing HTML pages"""
+import unittest
+
+from html import Writer, page_header, page_footer, table, detail, DType
+from html import table_finish
+
+
+class TestWriter(unittest.TestCase):
+    """Pages are collected by their own writer"""
+    def test_interleaved(self):
+        """Two pages written at the same time stay apart"""
+        first = Writer()
+        second = Writer()
+        page_header(first, 'First')
+        page_header(second, 'Second')
+        table(first, 'name', 'amount')
+        detail(first, DType.normal, 'run', '12#')
+        table_finish(first)
+        page_footer(first)
+        page_footer(second)
+        self.assertIn('<title>First</title>', first.getvalue())
+        self.assertNotIn('<table>', second.getvalue())
+        self.assertIn(
+            '<tr><td>run</td><td class="amount">12</td></tr>\n</table>',
+            first.getvalue())
+
+    def test_chunks(self):
+        """Chunks together are the whole page"""
+        out = Writer()
+        for nr in range(1000):
+            out.write('<p>', nr, '</p>\n')
+        parts = list(out.chunks(1000))
+        self.assertTrue(len(parts) > 10)
+        self.assertTrue(all(len(part) >= 1000 for part in parts[:-1]))
+        self.assertEqual(out.getvalue(), ''.join(parts))
+        self.assertEqual([''], list(Writer().chunks(1000)))
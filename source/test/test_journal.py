@@ -0,0 +1,138 @@
+"""Tests on the journal of changes"""
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from websockets.client import connect
+from websockets.server import serve
+
+from commit import GroupCommit
+from store import Store
+from journal import Journal
+from read import scan_file
+from server import Server
+from tables import tables_init
+
+
+def load(file):
+    """Read the data file and replay the journal"""
+    game = tables_init(Store())
+    scan_file(file, game)
+    serv = Server(game, None, file, Journal(file))
+    serv.replay()
+    return serv
+
+
+class TestJournal(unittest.TestCase):
+    """Append changes instead of writing the whole file"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'game.dbr')
+        shutil.copy('../data/game.dbr', self.file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        """Changes survive a restart and are folded back on compaction"""
+        serv = load(self.file)
+        serv.call('/write/action/run', '{"description": "Run away"}')
+        serv.call('/write/action', '{"name": "jump", "description": "Jump"}')
+        serv.call('/write/action', '{"name": "hop"}')  # no description
+        serv.call('/delete/action/stand', '')
+        serv.journal.close()
+        self.assertEqual(3, len(open(serv.journal.name).readlines()) - 1)
+        serv = load(self.file)
+        self.assertEqual(3, serv.journal.entries)
+        actions = serv.general.actions
+        self.assertEqual('Run away', actions[('run',)].description)
+        self.assertIn(('jump',), actions)
+        self.assertNotIn(('stand',), actions)
+        serv.journal.compact(serv.general)
+        serv.journal.close()
+        serv = load(self.file)
+        self.assertEqual(0, serv.journal.entries)
+        self.assertEqual(
+            'Run away', serv.general.actions[('run',)].description)
+        self.assertNotIn(('stand',), serv.general.actions)
+
+    def test_transaction(self):
+        """Changes in a transaction are journaled when it commits"""
+        serv = load(self.file)
+        store = serv.general.stored
+        with store.transaction():
+            serv.call('/write/action/run', '{"description": "Run away"}')
+            serv.call('/delete/action/stand', '')
+            self.assertEqual(0, serv.journal.entries)
+            with store.transaction() as inner:
+                serv.call('/write/action', '{"name": "hop"}')
+                inner.rollback()
+        serv.journal.close()
+        self.assertEqual(2, len(open(serv.journal.name).readlines()) - 1)
+        self.assertNotIn(('hop',), serv.general.actions)
+
+    def test_bulk(self):
+        """The rows of a bulk are journaled in one entry"""
+        serv = load(self.file)
+        serv.call('/bulk/action', '{"name": "jump", "description": "Jump"}\n'
+                  '{"name": "run"}\n{"name": "hop", "description": "Hop"}')
+        serv.journal.close()
+        self.assertEqual(1, len(open(serv.journal.name).readlines()) - 1)
+        serv = load(self.file)
+        self.assertEqual(1, serv.journal.entries)
+        self.assertEqual('Hop', serv.general.actions[('hop',)].description)
+        self.assertEqual('Jump', serv.general.actions[('jump',)].description)
+
+    def test_group_commit(self):
+        """Writes within the window share a single commit"""
+        serv = load(self.file)
+        serv.group.window = 0.05
+
+        async def session():
+            """Send the writes without waiting for the answers"""
+            server = await serve(serv.handler, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                ws = await connect('ws://localhost:' + str(port) + '/')
+                for nr in range(3):
+                    await ws.send(
+                        str(nr) + '\n/write/action\n{"name": "jump' +
+                        str(nr) + '", "description": "Jump"}')
+                answers = [await ws.recv() for _ in range(3)]
+                await ws.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return answers
+
+        answers = asyncio.run(session())
+        self.assertTrue(all('"added"' in answer for answer in answers))
+        self.assertEqual(1, serv.group.metrics['commits'])
+        self.assertEqual(3, serv.group.metrics['largest'])
+        serv.journal.close()
+        self.assertIn(('jump2',), load(self.file).general.actions)
+
+    def test_failed_commit(self):
+        """A commit that fails fails all writes of its group"""
+        def fail():
+            raise RuntimeError("Disk gone")
+
+        async def writes():
+            """Wait for the commit of two writes"""
+            # the failed commit is also raised to the loop, keep it quiet
+            asyncio.get_event_loop().set_exception_handler(
+                lambda loop, context: logged.append(context['exception']))
+            group.pending = 2
+            return await asyncio.gather(
+                group.wait(), group.wait(), return_exceptions=True)
+
+        logged = []
+        with ThreadPoolExecutor(1) as executor:
+            group = GroupCommit(fail, executor, window=0.01)
+            answers = asyncio.run(writes())
+        self.assertEqual(['Disk gone'] * 2, [str(e) for e in answers])
+        self.assertEqual(0, group.metrics['commits'])
+        self.assertIsNone(group.committed)
@@ -0,0 +1,87 @@
+"""Tests on queries with filters, sorting and projection"""
+import json
+import unittest
+
+from read import reading
+from server import Server
+
+DATA = """title=Test, statistics=[
+  type=training, name=agility
+  type=training, name=strength
+  type=skill, name=athletics, first_train={type=training, name=strength}
+  type=skill, name=climbing, first_train={type=training, name=agility}
+  type=skill, name=throwing, first_train={type=training, name=strength}
+], items=[
+  type=weapon, name=knife
+  type=armor, name=vest
+  type=weapon, name=rifle
+]"""
+
+
+def query(serv, table, data):
+    """Run a query through the server and parse the result"""
+    return json.loads(serv.call('/query/' + table, json.dumps(data)))
+
+
+class TestQuery(unittest.TestCase):
+    """Plan and run queries on the tables"""
+    def test_key_range(self):
+        """Conditions on the leading keys walk only a range of the set"""
+        serv = Server(reading(DATA), '.', None)
+        res = query(serv, 'statistic', {
+            'where': {'type': 'skill', 'name': {'>=': 'b', '<': 'th'}},
+            'fields': ['name']})
+        self.assertEqual('key range', res['plan'])
+        self.assertEqual(
+            [{'key': '0000002|climbing', 'name': 'climbing'}],
+            res['records'])
+
+    def test_not_equal_key(self):
+        """Only != on the first key is no range, the whole set is walked"""
+        serv = Server(reading(DATA), '.', None)
+        res = query(serv, 'statistic', {
+            'where': {'type': {'!=': 'training'}}, 'fields': ['name']})
+        self.assertEqual('scan', res['plan'])
+        self.assertEqual(
+            ['athletics', 'climbing', 'throwing'],
+            [r['name'] for r in res['records']])
+        res = query(serv, 'statistic', {
+            'where': {'type': {'in': ['training']}}, 'fields': ['name']})
+        self.assertEqual('scan', res['plan'])
+        self.assertEqual(
+            ['agility', 'strength'], [r['name'] for r in res['records']])
+
+    def test_index(self):
+        """An equality on an indexed field uses the secondary index"""
+        serv = Server(reading(DATA), '.', None)
+        res = query(serv, 'statistic', {
+            'where': {'first_train': '0000001|strength'},
+            'sort': ['-name'], 'fields': ['name', 'first_train']})
+        self.assertEqual('index first_train', res['plan'])
+        self.assertEqual(
+            ['throwing', 'athletics'], [r['name'] for r in res['records']])
+        self.assertEqual(
+            '0000001|strength', res['records'][0]['first_train'])
+
+    def test_limit(self):
+        """Sort a scan and only show the first records"""
+        serv = Server(reading(DATA), '.', None)
+        res = query(serv, 'item', {
+            'where': {'name': {'!=': 'vest'}}, 'sort': ['name'],
+            'limit': 1})
+        self.assertEqual('scan', res['plan'])
+        self.assertEqual(['knife'], [r['name'] for r in res['records']])
+        self.assertTrue(res['more'])
+        res = query(serv, 'item', {'where': {'type': {'in': ['armor']}}})
+        self.assertEqual(['vest'], [r['name'] for r in res['records']])
+        self.assertFalse(res['more'])
+
+    def test_errors(self):
+        """Unknown fields and operators give an error"""
+        serv = Server(reading(DATA), '.', None)
+        self.assertEqual(
+            "Unknown field 'colour'",
+            query(serv, 'item', {'where': {'colour': 'red'}})['message'])
+        self.assertEqual(
+            "Unknown operator '~'",
+            query(serv, 'item', {'where': {'name': {'~': 'k'}}})['message'])
@@ -0,0 +1,112 @@
+"""Tests on the sorted dictionary"""
+import random
+import unittest
+
+from rbtree import RBDict, Versions
+
+
+def check_tree(node):
+    """Check the red-black invariants, return the black height"""
+    if node is None:
+        return 1
+    if node.right is not None and node.right.red:
+        raise AssertionError("Right leaning red link on " + str(node.key))
+    if node.red and node.left is not None and node.left.red:
+        raise AssertionError("Two red links in a row on " + str(node.key))
+    if node.left is not None and not node.left.key < node.key:
+        raise AssertionError("Left key out of order on " + str(node.key))
+    if node.right is not None and not node.key < node.right.key:
+        raise AssertionError("Right key out of order on " + str(node.key))
+    left = check_tree(node.left)
+    if left != check_tree(node.right):
+        raise AssertionError("Unbalanced black height on " + str(node.key))
+    return left + (0 if node.red else 1)
+
+
+class TestRBDict(unittest.TestCase):
+    """Insert, delete and iterate on the tree"""
+    def test_order(self):
+        """Keys stay ordered and balanced after inserts and deletes"""
+        rnd = random.Random(1)
+        keys = ["{:07d}".format(rnd.randrange(100000)) for _ in range(3000)]
+        tree = RBDict()
+        shadow = {}
+        for key in keys:
+            tree[key] = key
+            shadow[key] = key
+        check_tree(tree.root)
+        self.assertEqual(sorted(shadow), tree.keys())
+        for key in keys[::3]:
+            if key in shadow:
+                del tree[key]
+                del shadow[key]
+                check_tree(tree.root)
+        self.assertEqual(len(shadow), len(tree))
+        self.assertEqual(sorted(shadow), tree.keys())
+        self.assertEqual([shadow[k] for k in sorted(shadow)], list(tree))
+        self.assertEqual(None, tree.get(keys[0]))
+        self.assertRaises(KeyError, tree.__getitem__, keys[0])
+
+    def test_change_during_iteration(self):
+        """An iterator continues after the last key when the tree changes"""
+        tree = RBDict()
+        for nr in range(10):
+            tree[nr] = nr
+        res = []
+        for val in tree:
+            res.append(val)
+            if val == 3:
+                del tree[4]
+                tree[20] = 20
+        self.assertEqual([0, 1, 2, 3, 5, 6, 7, 8, 9, 20], res)
+
+    def test_changes(self):
+        """Remember removed records"""
+        tree = RBDict({'a': 1, 'b': 2}, changes=True)
+        tree.changes()
+        del tree['a']
+        self.assertRaises(ValueError, tree.__setitem__, 'b', 3)
+        self.assertEqual([(1, None)], tree.changes())
+        self.assertFalse(tree.has_changes())
+
+    def test_range(self):
+        """Iterate only a slice of the keys"""
+        tree = RBDict()
+        for nr in range(3):
+            for name in ('a', 'b', 'c'):
+                key = "{:07d}|{}".format(nr, name)
+                tree[key] = key
+        self.assertEqual(
+            ['0000001|a', '0000001|b', '0000001|c'],
+            [k for k, _ in tree.prefix('0000001|')])
+        self.assertEqual(
+            ['0000000|c', '0000001|a'],
+            [k for k, _ in tree.range('0000000|c', '0000001|b')])
+        self.assertEqual([], list(tree.prefix('0000003|')))
+        self.assertEqual(9, len(list(tree.range())))
+
+    def test_snapshot(self):
+        """A pinned version stays the same while the tree changes"""
+        rnd = random.Random(2)
+        versions = Versions()
+        tree = RBDict(versions=versions)
+        for nr in range(500):
+            tree[rnd.randrange(2000)] = nr
+        before = tree.items()
+        gen = versions.pin()
+        for nr in range(500):
+            key = rnd.randrange(2000)
+            if key in tree:
+                del tree[key]
+            else:
+                tree[key] = nr
+        tree[before[0][0]] = 'changed'
+        check_tree(tree.root)
+        view = tree.at(gen)
+        self.assertEqual(before, view.items())
+        self.assertEqual(len(before), len(view))
+        self.assertRaises(ValueError, view.__setitem__, 1, 1)
+        versions.release(gen)
+        self.assertEqual('changed', tree[before[0][0]])
+        tree[-1] = -1
+        self.assertEqual([], tree.history)
@@ -0,0 +1,167 @@
+"""Tests on reading data files"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from store import Store
+from read import Scanner, scan_file, scan_file_parallel, split_blocks
+from read import stream_file
+from snapshot import load_snapshot, write_snapshot
+from tables import Value, tables_init
+
+FILE = '../data/game.dbr'
+
+
+class TestStream(unittest.TestCase):
+    """Read records one at a time"""
+    def test_paths(self):
+        """Every record is generated once with the path of its Set"""
+        game = tables_init(Store())
+        paths = {}
+        for path, rec in stream_file(FILE, game, keep=('statistics',)):
+            paths.setdefault(path, []).append(rec)
+        self.assertEqual(
+            [('statistics',), ('actions',), ('items', 'values'), ('items',)],
+            list(paths))
+        self.assertEqual(44, len(game.statistics))
+        self.assertEqual(0, len(game.items))
+        item = paths[('items',)][0]
+        self.assertEqual('crafter', item.name)
+        self.assertEqual(
+            'technician', item.values.values()[0].statistic.name)
+
+    def test_default(self):
+        """Without arguments the records are only generated, relations to
+           the records that are not kept stay empty"""
+        game = tables_init(Store())
+        recs = [rec for _, rec in stream_file(FILE, game)]
+        self.assertEqual(44 + 12 + 40 + 10, len(recs))
+        self.assertEqual(0, len(game.statistics) + len(game.items))
+        self.assertEqual({}, game.stored.referencing)
+        self.assertEqual({}, game.stored.referenced)
+
+    def test_values(self):
+        """Values keep their own key when the statistic is not resolved"""
+        full = tables_init(Store())
+        scan_file(FILE, full)
+        game = tables_init(Store())
+        items = [rec for path, rec in stream_file(FILE, game, resolve=False)
+                 if path == ('items',)]
+        self.assertEqual(10, len(items))
+        for item in items:
+            self.assertEqual(
+                full.items[item.get_key()].values.keys(), item.values.keys())
+        self.assertEqual(
+            [((2, 'medicine'),), ((2, 'technician'),)],
+            items[2].values.keys())
+        self.assertIsNone(items[2].values.values()[0].statistic)
+        self.assertEqual({}, game.stored.referencing)
+
+    def test_all(self):
+        """With keep None all records are stored and resolved"""
+        game = tables_init(Store())
+        recs = [rec for _, rec in stream_file(FILE, game, keep=None)]
+        self.assertEqual(44 + 12 + 40 + 10, len(recs))
+        self.assertEqual(10, len(game.items))
+        train = game.statistics[(2, 'athletics')].first_train
+        self.assertIs(game.statistics[(1, 'strength')], train)
+
+    def test_dropped(self):
+        """Relations to dropped tables are not kept for resolving"""
+        game = tables_init(Store())
+        with open(FILE) as fp:
+            scan = Scanner(fp)
+            for _ in scan.records(game, keep=('items',)):
+                self.assertEqual([], scan.unresolved)
+        self.assertEqual(10, len(game.items))
+        self.assertEqual(0, len(game.statistics))
+
+    def test_unresolved(self):
+        """Relations can be skipped, mmap gives the same records"""
+        game = tables_init(Store())
+        recs = [rec for _, rec in stream_file(
+            FILE, game, keep=None, resolve=False, use_mmap=True)]
+        self.assertEqual(44 + 12 + 40 + 10, len(recs))
+        self.assertIsNone(game.statistics[(2, 'athletics')].first_train)
+
+
+class TestParallel(unittest.TestCase):
+    """Top level Sets parsed in worker processes"""
+    def test_same(self):
+        """Small chunks give the same data as reading in one go"""
+        game = tables_init(Store())
+        scan_file(FILE, game)
+        parallel = tables_init(Store())
+        scan_file_parallel(FILE, parallel, workers=2, chunk_lines=7)
+        self.assertEqual(str(game), str(parallel))
+        train = parallel.statistics[(2, 'athletics')].first_train
+        self.assertIs(parallel.statistics[(1, 'strength')], train)
+        self.assertEqual(
+            6, len(parallel.stored.referenced_by(
+                parallel.statistics[(2, 'technician')])))
+
+    def test_snapshot(self):
+        """The Sets of records from the workers keep pinned versions"""
+        game = tables_init(Store())
+        scan_file_parallel(FILE, game, workers=2, chunk_lines=7)
+        item = game.items[(1, 'crafter')]
+        self.assertIs(game.stored.generations, item.values.versions)
+        with game.stored.snapshot() as snap:
+            before = len(snap.set(item, 'values'))
+            for value in item.values.values():
+                value.remove()
+            self.assertEqual(0, len(item.values))
+            self.assertEqual(before, len(snap.set(item, 'values')))
+        self.assertLess(0, before)
+
+    def test_chunks(self):
+        """Every top level Set is split in chunks, also a Set that starts
+           on the closing line of the Set before it"""
+        game = tables_init(Store())
+        with open(FILE) as fp:
+            _, chunks = split_blocks(fp, game, 7)
+        self.assertEqual(
+            {'statistics', 'actions', 'items'},
+            set(name for name, _, _ in chunks))
+        lines = ['title=T, statistics=[', '  type=skill, name=a',
+                 '], actions=[], items=[', '  type=armor, name=vest', ']']
+        top, chunks = split_blocks(iter(lines), game)
+        self.assertEqual(
+            ['title=T, statistics=[], actions=[], items=[]'], top)
+        self.assertEqual(
+            [('statistics', 2, ['  type=skill, name=a']),
+             ('items', 4, ['  type=armor, name=vest'])], chunks)
+
+    def test_empty(self):
+        """An empty file has no top level lines and no chunks"""
+        self.assertEqual(
+            ([], []), split_blocks(iter(()), tables_init(Store())))
+
+
+class TestSnapshot(unittest.TestCase):
+    """Binary snapshot next to the data file"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'game.dbr')
+        shutil.copy(FILE, self.file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        """A snapshot gives the same data until the data file changes"""
+        game = tables_init(Store())
+        self.assertFalse(load_snapshot(self.file, game))
+        scan_file(self.file, game)
+        write_snapshot(self.file, game)
+        loaded = tables_init(Store())
+        self.assertTrue(load_snapshot(self.file, loaded))
+        self.assertEqual(str(game), str(loaded))
+        train = loaded.statistics[(2, 'athletics')].first_train
+        self.assertIs(loaded.statistics[(1, 'strength')], train)
+        values = sum(len(item.values) for item in loaded.items.values())
+        self.assertEqual(values, loaded.stored.version(Value))  # once each
+        with open(self.file, 'a') as fp:
+            fp.write('\n')
+        self.assertFalse(load_snapshot(self.file, tables_init(Store())))
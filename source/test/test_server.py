@@ -0,0 +1,329 @@
+"""Tests on the websocket connections of the server"""
+import asyncio
+import json
+import unittest
+
+from websockets.client import connect
+from websockets.server import serve
+
+from read import reading
+from server import Server, split_message
+
+DATA = """title=Test, statistics=[
+  type=training, name=agility
+  type=training, name=strength
+], actions=[
+  name=run, description=Run away
+]"""
+
+
+class TestConnection(unittest.TestCase):
+    """Several requests on one websocket connection"""
+    def test_split(self):
+        """Messages with and without a request id"""
+        self.assertEqual(
+            (None, '/record/action/run', ''),
+            split_message('/record/action/run'))
+        self.assertEqual(
+            ('7', '/write/action/run', '{"a": "\\n"}'),
+            split_message('7\n/write/action/run\n{"a": "\\n"}'))
+
+    def test_pipeline(self):
+        """Answer tagged requests on a connection that stays open"""
+        serv = Server(reading(DATA), '.', None)
+
+        async def session():
+            """Send requests without waiting for the answers"""
+            server = await serve(serv.handler, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                ws = await connect('ws://localhost:' + str(port) + '/')
+                await ws.send('/fields/action')
+                first = await ws.recv()
+                for nr in range(3):
+                    await ws.send(str(nr) + '\n/fields/action')
+                answers = [await ws.recv() for _ in range(3)]
+                await ws.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return first, answers
+
+        first, answers = asyncio.run(session())
+        self.assertIn('"name":"description"', first)
+        self.assertEqual(
+            ['0', '1', '2'], sorted(a.split('\n', 1)[0] for a in answers))
+        self.assertTrue(all(a.split('\n', 1)[1] == first for a in answers))
+
+    def test_page(self):
+        """A HTML page is sent from its writer"""
+        serv = Server(reading(DATA), '.', None)
+
+        async def session():
+            """Ask for a form with a request id"""
+            server = await serve(serv.handler, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                ws = await connect('ws://localhost:' + str(port) + '/')
+                await ws.send('5\n/form/action/run')
+                answer = await ws.recv()
+                await ws.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return answer
+
+        answer = asyncio.run(session())
+        self.assertEqual(
+            '5\n' + serv.call('/form/action/run', ''), answer)
+        self.assertIn('<title>Edit action</title>', answer)
+
+
+class TestCache(unittest.TestCase):
+    """Responses are cached until their tables change"""
+    def test_versions(self):
+        """A change to a table or a related table misses the cache"""
+        serv = Server(reading(DATA), '.', None)
+        made = []
+        serv.cached('/x', 'statistic', lambda: made.append(1))
+        serv.cached('/x', 'statistic', lambda: made.append(1))
+        self.assertEqual((1, 1), (serv.cache.hits, len(made)))
+        serv.call('/write/statistic/0000001|agility',
+                  '{"description": "Quick"}')
+        serv.cached('/x', 'statistic', lambda: made.append(1))
+        self.assertEqual(2, len(made))
+        first = serv.call('/fields/action', '')
+        serv.call('/write/action', '{"name": "jump", "description": "J"}')
+        serv.cached('/x', 'statistic', lambda: made.append(1))
+        self.assertEqual(2, len(made))
+        self.assertEqual(first, serv.call('/fields/action', ''))
+        self.assertEqual(4, serv.cache.misses)
+
+    def test_evict(self):
+        """Only the least recently used responses are kept"""
+        serv = Server(reading(DATA), '.', None, cache_size=1)
+        serv.call('/fields/item', '')
+        serv.call('/fields/action', '')
+        serv.call('/fields/item', '')
+        self.assertEqual(0, serv.cache.hits)
+        self.assertEqual(2, serv.cache.evictions)
+
+
+class TestOptions(unittest.TestCase):
+    """Option lists of relation fields follow the changes"""
+    def test_options(self):
+        """Stored, changed and removed records update the options"""
+        serv = Server(reading(DATA), '.', None)
+        store = serv.general.stored
+        options = store.option_list(serv.records['statistic'])
+        self.assertEqual(
+            '<option value="0000001|agility">training agility</option>\n'
+            '<option value="0000001|strength" selected>'
+            'training strength</option>\n',
+            options.get_html('0000001|strength'))
+        serv.call('/write/statistic/0000001|agility', '{"name": "speed"}')
+        serv.call('/delete/statistic/0000001|strength', '')
+        self.assertEqual(
+            [{'key': '0000001|speed', 'value': 'training speed'}],
+            options.get_values())
+        self.assertIn(
+            '<option value="0000001|speed">training speed</option>',
+            serv.call('/form/statistic/0000001|speed', ''))
+
+
+class TestForm(unittest.TestCase):
+    """HTML forms to add and edit records"""
+    def test_add(self):
+        """The add form of every table renders for a new record"""
+        serv = Server(reading(DATA), '.', None)
+        for table in serv.records:
+            page = serv.call('/form/' + table, '')
+            self.assertIn('<form action=""', page)
+            self.assertIn('json_form("' + table + '"', page)
+
+
+class TestList(unittest.TestCase):
+    """Pages of records in a HTML table"""
+    def test_pages(self):
+        """Each page continues after the last key of the one before"""
+        serv = Server(reading(DATA), '.', None)
+        first = serv.call('/list/statistic?limit=1', '')
+        self.assertIn('statistic/0000001|agility', first)
+        self.assertNotIn('statistic/0000001|strength', first)
+        self.assertIn(
+            '<a href="/list/statistic?after=0000001%7Cagility&amp;limit=1">',
+            first)
+        second = serv.call(
+            '/list/statistic', '{"after": "0000001|agility", "limit": 1}')
+        self.assertIn('statistic/0000001|strength', second)
+        self.assertNotIn('class="more"', second)
+        self.assertIn(
+            'Incorrect limit', serv.call('/list/statistic?limit=0', ''))
+
+    def test_stream(self):
+        """A streamed list is sent in fragments of lines"""
+        serv = Server(reading(DATA), '.', None)
+        parts = []
+
+        async def handler(ws, path):
+            """Count the fragments the server sends"""
+            send = ws.send
+
+            async def counted(message):
+                """Keep the fragments of a fragmented message"""
+                if isinstance(message, str):
+                    await send(message)
+                    return
+
+                async def fragments():
+                    """Pass the fragments on"""
+                    async for text in message:
+                        parts.append(text)
+                        yield text
+                await send(fragments())
+            ws.send = counted
+            await serv.handler(ws, path)
+
+        async def session():
+            """Ask for a streamed list with a request id"""
+            server = await serve(handler, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                ws = await connect('ws://localhost:' + str(port) + '/')
+                await ws.send('3\n/list/statistic?stream=1')
+                answer = await ws.recv()
+                await ws.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return answer
+
+        answer = asyncio.run(session())
+        self.assertEqual('3\n' + serv.call('/list/statistic', ''), answer)
+        self.assertGreater(len(parts), 2)
+        self.assertEqual(answer, ''.join(parts))
+
+    def test_pinned(self):
+        """A list keeps showing the records as they were when it started
+           while writes go on between its lines"""
+        serv = Server(reading(DATA), '.', None)
+        parts = []
+
+        def send(text):
+            """Change the records after the first line is sent"""
+            parts.append(text)
+            if 'agility' in text:
+                serv.call('/delete/statistic/0000001|strength', '')
+                serv.call('/write/statistic/0000001|agility',
+                          '{"description": "Quick"}')
+                serv.call('/write/statistic/', json.dumps({
+                    'type': 'training', 'name': 'swim', 'description': 'S',
+                    'first_train': '0000001|agility',
+                    'second_train': '0000001|agility'}))
+
+        page = serv.call('/list/statistic?stream=1', '', True, send)
+        page = ''.join(parts) + page.getvalue()
+        self.assertIn('statistic/0000001|strength', page)
+        self.assertNotIn('Quick', page)
+        self.assertNotIn('swim', page)
+        page = serv.call('/list/statistic', '')
+        self.assertNotIn('statistic/0000001|strength', page)
+        self.assertIn('Quick', page)
+        self.assertIn('swim', page)
+
+    def test_record(self):
+        """Records and options are shown from a given snapshot"""
+        serv = Server(reading(DATA), '.', None)
+        with serv.general.stored.snapshot() as snap:
+            serv.call('/delete/statistic/0000001|strength', '')
+            res = json.loads(serv.call(
+                '/record/statistic/0000001|strength', '', snap=snap))
+            self.assertEqual('Statistic training strength', res['title'])
+            self.assertEqual(
+                ['0000001|agility', '0000001|strength'],
+                [opt['key'] for opt in res['fields'][3]['values']])
+        res = json.loads(serv.call('/record/statistic/0000001|strength', ''))
+        self.assertEqual('error', res['action'])
+
+    def test_no_stream(self):
+        """A stream flag of 0 in the url does not stream the list"""
+        serv = Server(reading(DATA), '.', None)
+        parts = []
+        page = serv.call('/list/statistic?stream=0', '', True, parts.append)
+        self.assertEqual([], parts)
+        serv.call('/list/statistic?stream=1', '', True, parts.append)
+        self.assertTrue(parts)
+        self.assertIn('statistic/0000001|agility', page.getvalue())
+
+
+class TestBulk(unittest.TestCase):
+    """Many records added with one request"""
+    def test_rows(self):
+        """Valid rows are added, the others are reported"""
+        serv = Server(reading(DATA), '.', None)
+        rows = [
+            {'table': 'action', 'data': {'name': 'walk', 'description': 'W'}},
+            {'table': 'action', 'data': {'name': 'walk', 'description': 'X'}},
+            {'table': 'action', 'data': {'name': 'run', 'description': 'R'}},
+            {'table': 'nothing', 'data': {}},
+            {'table': 'action', 'data': {'name': 'hop'}},
+            {'table': 'statistic',
+             'data': {'type': 'skill', 'name': 'climbing',
+                      'description': 'Climb',
+                      'first_train': '0000001|agility',
+                      'second_train': '0000001|strength'}}]
+        res = json.loads(serv.call('/bulk/', json.dumps(rows)))
+        self.assertEqual(2, res['added'])
+        self.assertEqual(
+            [(1, 'Errors in fields'), (2, 'Errors in fields'),
+             (3, 'Unknown table "nothing"'), (4, 'Errors in fields')],
+            [(e['row'], e['message']) for e in res['errors']])
+        self.assertEqual(
+            {'name': 'Duplicate key'}, res['errors'][1]['fields'])
+        general = serv.general
+        self.assertEqual('W', general.actions[('walk',)].description)
+        self.assertEqual(
+            'agility', general.statistics[(2, 'climbing')].first_train.name)
+
+    def test_stream(self):
+        """Rows on their own line are sent in several messages that are
+           each added"""
+        serv = Server(reading(DATA), '.', None)
+        lines = ['{"name": "a%d", "description": "A"}' % nr
+                 for nr in range(5)]
+        lines.insert(2, 'no json')
+        res = json.loads(serv.call('/bulk/action', '\n'.join(lines[:3])))
+        self.assertEqual(2, res['added'])
+        self.assertEqual(
+            [{'row': 2, 'message': 'Incorrect JSON'}], res['errors'])
+        res = json.loads(serv.call(
+            '/bulk/action?first=3', '\n'.join(lines[3:])))
+        self.assertEqual(3, res['added'])
+        self.assertEqual(6, len(serv.general.actions))
+        res = json.loads(serv.call('/bulk/action?first=6', lines[0]))
+        self.assertEqual('error', res['action'])
+        self.assertEqual(6, res['errors'][0]['row'])
+
+    def test_values(self):
+        """The values of a stored item are added as its sub records"""
+        items = ", items=[\n  type=weapon, name=knife\n]"
+        serv = Server(reading(DATA + items), '.', None)
+        rows = [
+            {'table': 'item/0000004|knife/values',
+             'data': {'statistic': '0000001|strength', 'value': '3'}},
+            {'table': 'item/0000004|knife/values',
+             'data': {'statistic': '0000001|agility', 'value': '2'}},
+            {'table': 'item/0000004|knife/values',
+             'data': {'statistic': '0000001|agility', 'value': '1'}},
+            {'table': 'item/0000004|sword/values',
+             'data': {'statistic': '0000001|agility', 'value': '1'}}]
+        res = json.loads(serv.call('/bulk/', json.dumps(rows)))
+        self.assertEqual(2, res['added'])
+        self.assertEqual(
+            [(2, 'Errors in fields'),
+             (3, 'Unknown table "item/0000004|sword/values"')],
+            [(e['row'], e['message']) for e in res['errors']])
+        values = serv.general.items[(4, 'knife')].values
+        self.assertEqual(
+            [('agility', 2), ('strength', 3)],
+            [(val.statistic.name, val.value) for val in values])
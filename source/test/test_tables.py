@@ -0,0 +1,210 @@
+"""Tests on the tables of the game"""
+import unittest
+
+from read import reading
+from tables import Statistic, Item
+
+DATA = """title=Test, statistics=[
+  type=training, name=agility
+  type=training, name=strength
+  type=skill, name=athletics, first_train={type=training, name=strength}
+  type=skill, name=climbing, first_train={type=training, name=agility}
+  type=skill, name=throwing, first_train={type=training, name=strength}
+], items=[
+  type=weapon, name=knife
+  type=armor, name=vest
+  type=weapon, name=rifle
+]"""
+
+
+class TestIndexes(unittest.TestCase):
+    """Secondary indexes on the tables"""
+    def test_lookup(self):
+        """Find records on an indexed field"""
+        game = reading(DATA)
+        store = game.stored
+        strength = game.statistics[(1, 'strength')]
+        self.assertEqual(
+            ['athletics', 'throwing'],
+            [r.name for r in store.lookup(Statistic, 'first_train', strength)])
+        weapon = Item.field_on_name['type'].read('weapon')
+        self.assertEqual(
+            ['knife', 'rifle'],
+            [r.name for r in store.lookup(Item, 'type', weapon)])
+
+    def test_change(self):
+        """Indexes follow removed and changed records"""
+        game = reading(DATA)
+        store = game.stored
+        agility = game.statistics[(1, 'agility')]
+        rec = game.statistics[(2, 'athletics')]
+        rec.remove()
+        rec.first_train = agility
+        rec.store()
+        game.statistics[(2, 'climbing')].remove()
+        self.assertEqual(
+            ['athletics'],
+            [r.name for r in store.lookup(Statistic, 'first_train', agility)])
+        rec.imp({'name': 'running'}, change=True)
+        self.assertEqual(
+            ['running'],
+            [r.name for r in store.lookup(Statistic, 'first_train', agility)])
+
+
+class TestReferences(unittest.TestCase):
+    """Index of the records that relate to a record"""
+    def test_removable(self):
+        """Only records without relations to them can be removed"""
+        game = reading(DATA)
+        strength = game.statistics[(1, 'strength')]
+        self.assertEqual(
+            ['statistic/0000002|athletics', 'statistic/0000002|throwing'],
+            strength.removable(game)['used'])
+        athletics = game.statistics[(2, 'athletics')]
+        self.assertIsNone(athletics.removable(game))
+        athletics.remove()
+        game.statistics[(2, 'throwing')].imp(
+            {'name': 'throw'}, change=True)
+        self.assertEqual(
+            ['statistic/0000002|throw'], strength.removable(game)['used'])
+
+    def test_cascade(self):
+        """Find all records that depend on a record"""
+        game = reading(DATA)
+        agility = game.statistics[(1, 'agility')]
+        self.assertEqual(
+            ['climbing'],
+            [rec.name for rec in game.stored.dependents(agility)])
+
+
+class TestSnapshot(unittest.TestCase):
+    """Read a pinned state while records change"""
+    def test_pinned(self):
+        """Changed, added and removed records keep their pinned state"""
+        game = reading(DATA)
+        with game.stored.snapshot() as snap:
+            game.statistics[(2, 'athletics')].imp(
+                {'name': 'running'}, change=True)
+            game.statistics[(2, 'climbing')].remove()
+            game.items[(4, 'knife')].imp({'type': 'armor'}, change=True)
+            self.assertEqual(
+                ['athletics', 'climbing', 'throwing'],
+                [rec.name for rec in snap.records(game, 'statistics')
+                 if rec.type == 2])
+            self.assertEqual(
+                ['knife', 'rifle'],
+                [rec.name for rec in snap.records(game, 'items')
+                 if rec.type == 4])
+        self.assertEqual(
+            ['running', 'throwing'],
+            [rec.name for rec in game.statistics if rec.type == 2])
+
+    def test_per_store(self):
+        """A snapshot of one store does not keep the trees of another"""
+        game = reading(DATA)
+        other = reading(DATA)
+        with game.stored.snapshot():
+            other.statistics[(2, 'athletics')].remove()
+            self.assertEqual([], other.statistics.history)
+            self.assertEqual({}, other.stored.kept)
+
+
+class TestChanges(unittest.TestCase):
+    """Changes are shown from the undo log"""
+    def test_changes(self):
+        """Only the changed fields and the keys are shown"""
+        game = reading(DATA)
+        store = game.stored
+        store.changes()
+        agility = game.statistics[(1, 'agility')]
+        agility.imp({'description': 'Quick'}, change=True)
+        agility.imp({'description': 'Quicker'}, change=True)
+        game.statistics[(1, 'strength')].imp({'name': 'power'}, change=True)
+        game.imp({'title': 'New'}, change=True)
+        self.assertEqual(
+            'title=New, statistics=[\n'
+            '  type=training, name=agility, description=Quicker\n'
+            '  type=training, name=power\n'
+            '  ! type=training, name=strength\n'
+            ']', game.changes())
+        self.assertEqual('', game.changes())
+        self.assertEqual([], store.undo)
+
+    def test_failed(self):
+        """A change to an existing key is undone"""
+        game = reading(DATA)
+        game.stored.changes()
+        rec = game.statistics[(2, 'climbing')]
+        self.assertRaises(
+            ValueError, rec.imp, {'name': 'throwing', 'description': 'X'},
+            change=True)
+        self.assertEqual('climbing', rec.name)
+        self.assertIsNone(rec.description)
+        self.assertIs(rec, game.statistics[(2, 'climbing')])
+        self.assertEqual('', game.changes())
+
+
+class TestTransaction(unittest.TestCase):
+    """Changes that are kept or rolled back together"""
+    def test_rollback(self):
+        """A failed transaction leaves the records and indexes as they were"""
+        game = reading(DATA)
+        store = game.stored
+        before = repr(game)
+        strength = game.statistics[(1, 'strength')]
+        athletics = game.statistics[(2, 'athletics')]
+        with self.assertRaises(ValueError):
+            with store.transaction():
+                athletics.imp({'name': 'running'}, change=True)
+                store.relate(athletics, 'first_train', None)
+                game.statistics[(2, 'climbing')].remove()
+                new = Statistic(game)
+                new.imp({'type': 'skill', 'name': 'jumping'})
+                game.imp({'title': 'Other'}, change=True)
+                new.imp({'name': 'throwing'}, change=True)  # existing key
+        self.assertEqual(before, repr(game))
+        self.assertEqual(
+            ['athletics', 'throwing'],
+            [r.name for r in store.lookup(Statistic, 'first_train', strength)])
+        self.assertEqual(
+            ['agility', 'strength', 'athletics', 'climbing', 'throwing'],
+            [v['key'].split('|')[1]
+             for v in store.option_list(Statistic).get_values()])
+        self.assertIsNone(store.trans)
+
+    def test_validate(self):
+        """Removing a record that is still used fails at commit"""
+        game = reading(DATA)
+        store = game.stored
+        before = repr(game)
+        agility = game.statistics[(1, 'agility')]
+        with self.assertRaises(ValueError):
+            with store.transaction():
+                game.statistics[(1, 'strength')].imp(
+                    {'description': 'Strong'}, change=True)
+                agility.remove()
+        self.assertEqual(before, repr(game))
+        self.assertIs(agility, game.statistics[(1, 'agility')])
+        with store.transaction():
+            game.statistics[(2, 'climbing')].remove()
+            agility.remove()
+        self.assertNotIn((1, 'agility'), game.statistics)
+
+    def test_nested(self):
+        """An inner transaction rolls back to its own start"""
+        game = reading(DATA)
+        store = game.stored
+        done = []
+        with store.transaction() as outer:
+            outer.on_commit(lambda: done.append('outer'))
+            game.statistics[(1, 'agility')].imp(
+                {'description': 'Quick'}, change=True)
+            with store.transaction() as inner:
+                inner.on_commit(lambda: done.append('inner'))
+                game.statistics[(1, 'strength')].imp(
+                    {'description': 'Strong'}, change=True)
+                inner.rollback()
+            self.assertEqual([], done)
+        self.assertEqual(['outer'], done)
+        self.assertEqual('Quick', game.statistics[(1, 'agility')].description)
+        self.assertIsNone(game.statistics[(1, 'strength')].description)
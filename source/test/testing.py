@@ -3,8 +3,8 @@ import os
 import unittest
 import subprocess
 
-from fields import String, Number, Enum, Set, Record, Store
-from rbtree import RBDict
+from fields import String, Number, Enum, Set, Record
+from store import Store
 from read import scan_file, reading
 from server import Server
 
@@ -23,21 +23,19 @@ class Step(Record):
     keys = ['step']
 
     def __init__(self, parent):
-        self.parent = parent
+        super().__init__(parent)
         self.step = len(parent.steps) + 1
         self.type = 1
         self.url = ''
         self.data = ''
-        self.response = None
-        self.changes = None
 
     def store(self):
         """Store the Step"""
-        self.parent.steps[self.get_id()] = self
+        self.parent.steps[self.get_key()] = self
 
     def remove(self):
         """Remove the Step from the test"""
-        del self.parent.steps[self.get_id()]
+        del self.parent.steps[self.get_key()]
 
     def removable(self, general):
         """This record can be removed savely"""
@@ -63,8 +61,8 @@ class TestFile(Record):
         Set('steps', Step)]
 
     def __init__(self):
+        super().__init__()
         self.description = ''
-        self.steps = RBDict()
 
     def store(self):
         """This this the top level element"""